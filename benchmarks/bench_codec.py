@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Compare the size and speed of the znode payload codecs"""
+
+import sys
+import os
+import time
+import json
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+from zkfarmer import codec
+from bench_yaml import farm
+
+
+def best(func, values):
+    timings = []
+    for i in range(3):
+        start = time.time()
+        result = [func(value) for value in values]
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    nodes = farm(count).values()
+    codecs = [("json (stdlib)", json.dumps, json.loads)]
+    if codec.ujson is not None:
+        codecs.append(("json (ujson)", codec.CodecJSON().encode, codec.decode))
+    if codec.msgpack is not None:
+        codecs.append(("msgpack", codec.CodecMsgpack().encode, codec.decode))
+    for name, encode, decode in codecs:
+        encode_elapsed, payloads = best(encode, nodes)
+        decode_elapsed, decoded = best(decode, payloads)
+        assert decoded == nodes, "decoded nodes differ"
+        print "%-14s %d nodes, %7d bytes: encode %.2f us/node, decode %.2f us/node" % (
+            name, count, sum(len(payload) for payload in payloads),
+            encode_elapsed * 1e6 / count, decode_elapsed * 1e6 / count)
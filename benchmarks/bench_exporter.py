@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Measure the exporter on a large farm stored in the in-memory ZooKeeper
+
+    bench_exporter.py [nodes] [latency in ms]
+"""
+
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+from zkfarmer.testing import FakeZooKeeper
+from zkfarmer.watcher import ZkFarmExporter
+from zkfarmer.utils import serialize
+from bench_yaml import farm
+
+
+class NullConf(object):
+    def write(self, obj):
+        pass
+
+
+def bench(count, latency):
+    zookeeper = FakeZooKeeper()
+    loader = zookeeper.client()
+    loader.start()
+    nodes = farm(count)
+    loader.ensure_path("/services/db")
+    for name, info in nodes.iteritems():
+        loader.create("/services/db/%s" % name, serialize(info))
+
+    client = zookeeper.client(latency=latency)
+    client.start()
+    exporter = ZkFarmExporter(client, "/services/db", NullConf())
+    start = time.time()
+    exporter.loop(2, timeout=1)
+    initial = time.time() - start
+    print "initial export of %d nodes: %.2fs, %s" % (count, initial, dict(client.requests))
+
+    client.requests.clear()
+    name = sorted(nodes)[0]
+    loader.set("/services/db/%s" % name, serialize(dict(nodes[name], enabled=u"0")))
+    start = time.time()
+    exporter.loop(1, timeout=1)
+    print "node update: %.2fms, %s" % ((time.time() - start) * 1000, dict(client.requests))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.001
+    bench(count, latency)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Compare compiled filters with match_predicates on synthetic nodes
+
+FarmTable is timed from the nodes, including the build of the table,
+as done by a one-shot `stats' or filter.
+"""
+
+import sys
+import os
+import time
+import random
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+from zkfarmer.utils import create_filter, parse_filter, match_predicates
+from zkfarmer import table
+
+FILTERS = "enabled=1,mysql.replication_delay<10,!maintenance"
+
+
+def nodes(count):
+    rnd = random.Random(42)
+    result = []
+    for i in xrange(count):
+        node = {"hostname": "db-%05d.example.com" % i,
+                "enabled": rnd.choice(["0", "1"]),
+                "weight": str(rnd.randint(0, 100)),
+                "mysql": {"replication_delay": str(rnd.randint(0, 20))}}
+        if rnd.random() < 0.1:
+            node["maintenance"] = "1"
+        result.append(node)
+    return result
+
+
+def timed(func, farm):
+    start = time.time()
+    matched = len([node for node in farm if func(node)])
+    return time.time() - start, matched
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    farm = nodes(count)
+    predicates = parse_filter(FILTERS)
+    legacy = lambda node: match_predicates(predicates, node)
+    compiled = create_filter(FILTERS)
+    for name, func in [("match_predicates", legacy), ("create_filter", compiled)]:
+        elapsed, matched = min(timed(func, farm) for i in range(3))
+        print "%-16s %d nodes, %d matched: %.3fs (%.2f us/node)" % (name, count, matched,
+                                                                    elapsed, elapsed * 1e6 / count)
+    if table.numpy is not None:
+        timings = []
+        by_name = dict((node["hostname"], node) for node in farm)
+        for i in range(3):
+            start = time.time()
+            matched = int(table.FarmTable(by_name).mask(FILTERS).sum())
+            timings.append(time.time() - start)
+        elapsed = min(timings)
+        print "%-16s %d nodes, %d matched: %.3fs (%.2f us/node)" % ("FarmTable", count, matched,
+                                                                    elapsed, elapsed * 1e6 / count)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Benchmark the hot paths of zkfarmer on synthetic farms
+
+Results are written as JSON so that runs can be compared with
+--compare, which exits with a non-zero status when a benchmark got
+slower than the given threshold:
+
+    bench_suite.py -o before.json
+    bench_suite.py --compare before.json
+"""
+
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import platform
+import itertools
+import subprocess
+import argparse
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+from zkfarmer.utils import serialize, unserialize, create_filter, parse_filter, match_predicates, dict_get_path
+from zkfarmer.conf import ConfJSON, ConfYAML, ConfPHP, ConfDir
+from zkfarmer import codec, conf
+from bench_yaml import farm
+
+FILTERS = "enabled=1,mysql.replication_delay<10,weight>20"
+SIZES = [100, 10000, 100000]
+
+CASES = []
+
+
+def case(name, max_size=None):
+    """Register a benchmark
+
+    The decorated function receives the farm and a temporary
+    directory, and returns the function to time. Farms larger than
+    `max_size` nodes are skipped.
+    """
+    def register(func):
+        CASES.append((name, func, max_size))
+        return func
+    return register
+
+
+@case("serialize")
+def bench_serialize(nodes, tmpdir):
+    infos = nodes.values()
+    return lambda: [serialize(info) for info in infos]
+
+
+@case("unserialize")
+def bench_unserialize(nodes, tmpdir):
+    payloads = [serialize(info) for info in nodes.itervalues()]
+    return lambda: [unserialize(payload) for payload in payloads]
+
+
+@case("create_filter")
+def bench_create_filter(nodes, tmpdir):
+    infos = nodes.values()
+    def run():
+        match = create_filter(FILTERS)
+        return [info for info in infos if match(info)]
+    return run
+
+
+@case("match_predicates")
+def bench_match_predicates(nodes, tmpdir):
+    infos = nodes.values()
+    def run():
+        predicates = parse_filter(FILTERS)
+        return [info for info in infos if match_predicates(predicates, info)]
+    return run
+
+
+@case("dict_get_path")
+def bench_dict_get_path(nodes, tmpdir):
+    infos = nodes.values()
+    return lambda: [dict_get_path(info, "mysql.replication_delay") for info in infos]
+
+
+def conf_path(conf_class, tmpdir, name):
+    path = os.path.join(tmpdir, name)
+    if conf_class is ConfDir:
+        os.mkdir(path)
+    return path
+
+
+def encoded(obj):
+    """Encode the strings of `obj` as UTF-8, as ConfDir writes them as is"""
+    if isinstance(obj, dict):
+        return dict((key.encode("utf-8"), encoded(val)) for key, val in obj.iteritems())
+    return obj.encode("utf-8")
+
+
+def conf_write(conf_class, extension):
+    def bench(nodes, tmpdir):
+        if conf_class is ConfDir:
+            nodes = encoded(nodes)
+        # A new file each time, unchanged content is never written
+        counter = itertools.count()
+        return lambda: conf_class(conf_path(conf_class, tmpdir, "%d.%s" % (next(counter), extension))).write(nodes)
+    return bench
+
+
+def conf_read(conf_class, extension):
+    def bench(nodes, tmpdir):
+        path = conf_path(conf_class, tmpdir, "farm.%s" % extension)
+        conf_class(path).write(encoded(nodes) if conf_class is ConfDir else nodes)
+        return lambda: conf_class(path).read()
+    return bench
+
+
+for conf_class, extension, max_size in [(ConfJSON, "json", None),
+                                        (ConfYAML, "yaml", None),
+                                        (ConfPHP, "php", None),
+                                        (ConfDir, "dir", 10000)]:
+    name = conf_class.__name__
+    case("%s.write" % name, max_size)(conf_write(conf_class, extension))
+    if conf_class is not ConfPHP:
+        case("%s.read" % name, max_size)(conf_read(conf_class, extension))
+
+
+def timed(func, number):
+    start = time.time()
+    for i in xrange(number):
+        func()
+    return (time.time() - start) / number
+
+
+def run(name, setup, size, repeat, min_time):
+    nodes = farm(size)
+    tmpdir = tempfile.mkdtemp(prefix="zkfarmer-bench-")
+    try:
+        func = setup(nodes, tmpdir)
+        # Small farms are run several times per measure to get
+        # meaningful timings
+        first = timed(func, 1)
+        number = max(1, int(min_time / max(first, 1e-6)))
+        timings = sorted(timed(func, number) for i in xrange(repeat))
+    finally:
+        shutil.rmtree(tmpdir)
+    return {"name": name,
+            "size": size,
+            "number": number,
+            "repeat": repeat,
+            "min": timings[0],
+            "median": timings[len(timings) // 2],
+            "per_node_us": timings[0] * 1e6 / size}
+
+
+def metadata():
+    try:
+        git = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                               stderr=open(os.devnull, "w"),
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        revision = git.communicate()[0].strip() if git.wait() == 0 else None
+    except OSError:
+        revision = None
+    return {"time": time.time(),
+            "revision": revision,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "libyaml": conf.CSafeDumper is not None,
+            "ujson": codec.ujson is not None}
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of each result over the baseline, return the regressions"""
+    previous = dict(((r["name"], r["size"]), r) for r in baseline["results"])
+    regressions = []
+    for result in results:
+        before = previous.get((result["name"], result["size"]))
+        if before is None:
+            continue
+        ratio = result["min"] / before["min"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(result)
+            flag = " REGRESSION"
+        print >> sys.stderr, "%-16s %7d nodes: %10.2f -> %10.2f us/node (x%.2f)%s" % (
+            result["name"], result["size"], before["per_node_us"], result["per_node_us"], ratio, flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark zkfarmer on synthetic farms.")
+    parser.add_argument("-s", "--sizes", default=",".join(str(s) for s in SIZES),
+                        help="comma separated farm sizes (default %(default)s)")
+    parser.add_argument("-b", "--bench", action="append", metavar="NAME",
+                        help="only run the given benchmark, may be repeated (default all of: %s)" %
+                        ", ".join(name for name, _, _ in CASES))
+    parser.add_argument("-r", "--repeat", default=5, type=int,
+                        help="number of measures, the best one is kept (default %(default)s)")
+    parser.add_argument("--min-time", default=0.05, type=float, metavar="SECONDS",
+                        help="minimum duration of a measure (default %(default)s)")
+    parser.add_argument("-o", "--output", metavar="PATH",
+                        help="write the results to PATH (default stdout)")
+    parser.add_argument("-c", "--compare", metavar="PATH",
+                        help="compare with previous results and exit with status 1 on regressions")
+    parser.add_argument("-t", "--threshold", default=0.2, type=float,
+                        help="relative slowdown considered as a regression (default %(default)s)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = []
+    for name, setup, max_size in CASES:
+        if args.bench and name not in args.bench:
+            continue
+        for size in sizes:
+            if max_size is not None and size > max_size:
+                print >> sys.stderr, "%-16s %7d nodes: skipped" % (name, size)
+                continue
+            result = run(name, setup, size, args.repeat, args.min_time)
+            results.append(result)
+            if not args.compare:
+                print >> sys.stderr, "%-16s %7d nodes: %10.2f us/node" % (name, size, result["per_node_us"])
+
+    output = json.dumps({"meta": metadata(), "results": results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    elif not args.compare:
+        print output
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Measure the per-event overhead of ZkFarmWatcher.loop
+
+The transition lookup is also timed alone, both through the compiled
+TRANSITIONS table and through the previous dispatch, which scanned
+EVENTS and resolved the handler by name with getattr, as a baseline.
+"""
+
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+from zkfarmer.watcher import ZkFarmWatcher
+
+
+class FakeConnection(object):
+    def add_listener(self, listener):
+        pass
+
+
+class BenchWatcher(ZkFarmWatcher):
+
+    EVENTS = { "initial setup":          [("initial",   "idle")],
+               "node modified":          [("idle",      "idle"),
+                                          ("lost",      "lost")],
+               "children modified":      [("idle",      "idle"),
+                                          ("lost",      "lost")],
+               "connection lost":        [("idle",      "lost"),
+                                          ("lost",      "lost")] }
+
+    def exec_node_modified_from_idle(self, what):
+        pass
+
+
+def bench(events):
+    w = BenchWatcher(FakeConnection())
+    w.state = "idle"
+    for i in xrange(events):
+        w.event("node modified", i)
+    start = time.time()
+    w.loop(events, timeout=0)
+    return time.time() - start
+
+
+def bench_table(events):
+    w = BenchWatcher(FakeConnection())
+    w.state = "idle"
+    transitions = w.TRANSITIONS
+    start = time.time()
+    for i in xrange(events):
+        state, execute = transitions["node modified", w.state]
+        if execute is not None:
+            execute(w, i)
+    return time.time() - start
+
+
+def bench_getattr(events):
+    w = BenchWatcher(FakeConnection())
+    w.state = "idle"
+    start = time.time()
+    for i in xrange(events):
+        event = "node modified"
+        transition = [t for t in w.EVENTS[event] if t[0] == w.state][0]
+        execute = getattr(w, "exec_%s_from_%s" % (event.replace(" ", "_"),
+                                                  transition[0].replace(" ", "_")),
+                          None)
+        if execute is None:
+            execute = getattr(w, "exec_%s" % event.replace(" ", "_"), None)
+        if execute is not None:
+            execute(i)
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, func in [("loop", bench),
+                       ("dispatch table", bench_table),
+                       ("getattr dispatch (baseline)", bench_getattr)]:
+        best = min(func(events) for i in range(5))
+        print "%s, %d events: %.2f us/event" % (name, events, best * 1e6 / events)
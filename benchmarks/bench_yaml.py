@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Compare the pure Python YAML serializer with the one used by ConfYAML"""
+
+import sys
+import os
+import time
+import random
+import yaml
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+from zkfarmer import conf
+
+
+def farm(count):
+    rnd = random.Random(42)
+    result = {}
+    for i in xrange(count):
+        hostname = u"db-%05d.example.com" % i
+        result[hostname] = {u"hostname": hostname,
+                            u"ip": u"10.0.%d.%d" % (i // 256 % 256, i % 256),
+                            u"enabled": rnd.choice([u"0", u"1"]),
+                            u"weight": unicode(rnd.randint(0, 100)),
+                            u"description": u"Serveur de donn\xe9es " * rnd.randint(0, 4),
+                            u"mysql": {u"replication_delay": unicode(rnd.randint(0, 20)),
+                                       u"version": u"5.5.%d-log" % rnd.randint(10, 30)}}
+    return result
+
+
+def best(func, *args):
+    timings = []
+    for i in range(3):
+        start = time.time()
+        result = func(*args)
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def legacy_dump(obj):
+    return yaml.dump(obj, Dumper=yaml.SafeDumper, default_flow_style=False, allow_unicode=True)
+
+
+def dump(obj):
+    return yaml.dump(obj, Dumper=conf.yaml_dumper(obj), default_flow_style=False, allow_unicode=True)
+
+
+if __name__ == "__main__":
+    print "libyaml: %s" % ("yes" if conf.CSafeDumper is not None else "no")
+    for count in [int(c) for c in sys.argv[1:]] or [1000, 10000]:
+        obj = farm(count)
+        legacy_elapsed, legacy = best(legacy_dump, obj)
+        elapsed, output = best(dump, obj)
+        assert output == legacy, "output differs"
+        print "dump %6d nodes (%d bytes): %.3fs -> %.3fs (x%.1f)" % (count, len(output), legacy_elapsed,
+                                                                  elapsed, legacy_elapsed / elapsed)
+        legacy_elapsed, legacy = best(yaml.load, output, yaml.SafeLoader)
+        elapsed, loaded = best(yaml.load, output, conf.YAMLLoader)
+        assert loaded == legacy, "loaded object differs"
+        print "load %6d nodes (%d bytes): %.3fs -> %.3fs (x%.1f)" % (count, len(output), legacy_elapsed,
+                                                                  elapsed, legacy_elapsed / elapsed)
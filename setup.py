@@ -29,6 +29,9 @@ setup(
     description='Easy distributed server farm management using Apache ZooKeeper.',
     long_description=open('README.md').read(),
     install_requires=parse_requirements('requirements.txt'),
+    extras_require={'stats': ['numpy'],
+                    'msgpack': ['msgpack'],
+                    'ujson': ['ujson']},
     tests_require = [ "nose", "mock" ] + parse_requirements('requirements.txt'),
     test_suite="nose.collector"
 )
@@ -0,0 +1,92 @@
+import unittest
+import json
+
+from zkfarmer.watcher import ZkFarmChecker
+from zkfarmer.zkfarmer import ZkFarmer
+from zkfarmer.nagios import PassiveResultWriter
+from kazoo.testing import KazooTestCase
+from mock import Mock
+
+class TestZkChecker(KazooTestCase):
+
+    TIMEOUT=0.1
+
+    def setUp(self):
+        KazooTestCase.setUp(self)
+        self.handler = Mock()
+        self.farmer = ZkFarmer(self.client)
+
+    def checker(self, max_failed_node="1", warn_failed_node=None):
+        def check_handler(zknode, props, nodes):
+            return self.farmer._evaluate(zknode, props, nodes, max_failed_node, warn_failed_node)
+        return ZkFarmChecker(self.client, "/services/db", check_handler, self.handler)
+
+    def farm(self, size, running, running_filter=None):
+        props = {"size": size}
+        if running_filter is not None:
+            props["running_filter"] = running_filter
+        self.client.ensure_path("/services/db")
+        self.client.set("/services/db", json.dumps(props))
+        for i in range(running):
+            self.client.create("/services/db/10.0.0.%d" % i, json.dumps({"enabled": "1"}))
+
+    def test_initial_status(self):
+        """Test the status is reported once the farm is fetched"""
+        self.farm(3, 3)
+        z = self.checker()
+        z.loop(3, timeout=self.TIMEOUT)
+        self.handler.assert_called_once_with("/services/db", ZkFarmer.STATUS_OK,
+                                             "3/3 nodes running, 0 nodes failing, max allowed 1")
+
+    def test_missing_farm(self):
+        """Test a missing farm is not created and is noticed once created"""
+        z = self.checker()
+        z.loop(3, timeout=self.TIMEOUT)
+        self.assertEqual(self.client.exists("/services/db"), None)
+        self.handler.assert_called_once_with("/services/db", ZkFarmer.STATUS_OK,
+                                             "0/0 nodes running, 0 nodes failing, max allowed 1")
+        self.handler.reset_mock()
+        self.farm(3, 1)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.assertEqual(self.handler.call_count, 1)
+        self.assertEqual(self.handler.call_args[0][:2], ("/services/db", ZkFarmer.STATUS_CRITICAL))
+
+    def test_status_change_only(self):
+        """Test results are only reported when the status changes"""
+        self.farm(4, 4)
+        z = self.checker("2", "1")
+        z.loop(3, timeout=self.TIMEOUT)
+        self.handler.reset_mock()
+        self.client.delete("/services/db/10.0.0.3")
+        z.loop(2, timeout=self.TIMEOUT)
+        self.handler.assert_called_once_with("/services/db", ZkFarmer.STATUS_WARNING,
+                                             "3/4 nodes running, 1 nodes failing, max allowed 2")
+        self.handler.reset_mock()
+        self.client.create("/services/db/10.0.0.4", json.dumps({"enabled": "1"}))
+        self.client.delete("/services/db/10.0.0.4")
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertFalse(self.handler.called)
+
+    def test_running_filter(self):
+        """Test node and farm property changes are evaluated"""
+        self.farm(3, 3, "enabled=1")
+        z = self.checker()
+        z.loop(3, timeout=self.TIMEOUT)
+        self.handler.reset_mock()
+        self.client.set("/services/db/10.0.0.0", json.dumps({"enabled": "0"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.handler.assert_called_once_with("/services/db", ZkFarmer.STATUS_CRITICAL,
+                                             "2/3 nodes running, 1 nodes failing, max allowed 1")
+        self.handler.reset_mock()
+        self.client.set("/services/db", json.dumps({"size": 3}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.handler.assert_called_once_with("/services/db", ZkFarmer.STATUS_OK,
+                                             "3/3 nodes running, 0 nodes failing, max allowed 1")
+
+class TestPassiveResultWriter(unittest.TestCase):
+
+    def test_format(self):
+        """Test results are formatted as Nagios external commands"""
+        w = PassiveResultWriter(host="nagios1", service="farm %s")
+        self.assertEqual(w.format("/services/db", ZkFarmer.STATUS_WARNING, "1 nodes\nfailing", 1234),
+                         "[1234] PROCESS_SERVICE_CHECK_RESULT;nagios1;farm /services/db;1;1 nodes failing\n")
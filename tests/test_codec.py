@@ -0,0 +1,121 @@
+import unittest
+import json
+from mock import patch
+from nose.plugins.skip import SkipTest
+
+from zkfarmer import codec, utils, metrics
+
+class TestCodec(unittest.TestCase):
+
+    DATA = {u"enabled": u"1", u"hostname": u"caf\xe9", u"weight": 10,
+            u"load": 0.5, u"maintenance": None, u"mysql": {u"delay": [1, 2]}}
+
+    def test_json(self):
+        """Check JSON payloads have no header and are still plain JSON."""
+        payload = codec.Codec("json").encode(self.DATA)
+        self.assertEqual(json.loads(payload), self.DATA)
+        self.assertEqual(codec.detect(payload).name, "json")
+        self.assertEqual(codec.decode(payload), self.DATA)
+
+    def test_json_legacy(self):
+        """Check we can read payloads written by the standard library."""
+        self.assertEqual(codec.decode(json.dumps(self.DATA, indent=4)), self.DATA)
+        self.assertEqual(codec.decode(' {"a": "b"}'), {"a": "b"})
+
+    def test_json_without_ujson(self):
+        """Check the standard library is used when ujson is missing."""
+        with patch.object(codec, "ujson", None):
+            payload = codec.Codec().encode(self.DATA)
+            self.assertEqual(payload, json.dumps(self.DATA))
+            self.assertEqual(codec.decode(payload), self.DATA)
+
+    def test_json_fallback(self):
+        """Check values not handled by ujson are still encoded."""
+        self.assertEqual(codec.decode(codec.Codec().encode({"a": 10 ** 30})), {"a": 10 ** 30})
+
+    def test_msgpack(self):
+        """Check msgpack payloads are detected from their header."""
+        if codec.msgpack is None:
+            raise SkipTest("msgpack is not installed")
+        payload = codec.Codec("msgpack").encode(self.DATA)
+        self.assertEqual(payload[0], codec.CodecMsgpack.header)
+        self.assertTrue(len(payload) < len(codec.Codec("json").encode(self.DATA)))
+        self.assertEqual(codec.detect(payload).name, "msgpack")
+        self.assertEqual(utils.unserialize(payload), self.DATA)
+        self.assertTrue(isinstance(utils.unserialize(payload).keys()[0], unicode))
+
+    def test_msgpack_missing(self):
+        """Check we get an error when msgpack is not installed."""
+        with patch.object(codec, "msgpack", None):
+            self.assertRaises(RuntimeError, codec.Codec, "msgpack")
+            self.assertEqual(utils.unserialize(codec.CodecMsgpack.header + "\x80"), {})
+
+    def test_unknown(self):
+        """Check we get an error for an unknown codec."""
+        self.assertRaises(ValueError, codec.Codec, "xml")
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        codec.compression.reset()
+        metrics.REGISTRY.reset()
+
+    def test_small_payload(self):
+        """Check small payloads are not compressed."""
+        payload = utils.serialize({"enabled": "1"})
+        self.assertEqual(json.loads(payload), {"enabled": "1"})
+        self.assertEqual(codec.compression.compressed, 0)
+
+    def test_large_payload(self):
+        """Check large payloads are compressed and read transparently."""
+        data = dict(("key%d" % i, "value %d" % i) for i in range(10000))
+        payload = utils.serialize(data)
+        self.assertEqual(payload[0], codec.COMPRESSED)
+        self.assertTrue(len(payload) < codec.COMPRESS_THRESHOLD)
+        self.assertEqual(utils.unserialize(payload), data)
+        self.assertEqual(codec.detect(payload).name, "json")
+        self.assertEqual(codec.compression.compressed, 1)
+        self.assertEqual(codec.compression.decompressed, 1)
+        self.assertEqual(codec.compression.compressed_bytes, len(payload))
+        self.assertTrue(codec.compression.ratio < 0.5)
+
+    def test_metrics(self):
+        """Check the compression counters are exported"""
+        data = dict(("key%d" % i, "value %d" % i) for i in range(10000))
+        payload = utils.serialize(data)
+        utils.unserialize(payload)
+        utils.serialize({"a": "bcd"}, compress_threshold=5)
+        raw = len(utils.serialize(data, compress_threshold=None))
+        lines = metrics.REGISTRY.render().splitlines()
+        for line in ['zkfarmer_codec_bytes_total{stage="raw"} %d' % raw,
+                     'zkfarmer_codec_bytes_total{stage="compressed"} %d' % len(payload),
+                     'zkfarmer_codec_payloads_total{result="compressed"} 1',
+                     'zkfarmer_codec_payloads_total{result="incompressible"} 1',
+                     'zkfarmer_codec_payloads_total{result="decompressed"} 1']:
+            self.assertTrue(line in lines, line)
+
+    def test_threshold(self):
+        """Check the compression threshold can be changed."""
+        payload = utils.serialize({"enabled": "1" * 100}, compress_threshold=10)
+        self.assertEqual(payload[0], codec.COMPRESSED)
+        self.assertEqual(utils.unserialize(payload), {"enabled": "1" * 100})
+        payload = utils.serialize({"enabled": "1" * 100}, compress_threshold=None)
+        self.assertEqual(json.loads(payload), {"enabled": "1" * 100})
+
+    def test_incompressible(self):
+        """Check payloads not shrinking are left uncompressed."""
+        data = {"a": "bcd"}
+        payload = utils.serialize(data, compress_threshold=5)
+        self.assertEqual(json.loads(payload), data)
+        self.assertEqual(codec.compression.incompressible, 1)
+        self.assertEqual(codec.compression.ratio, None)
+
+    def test_msgpack(self):
+        """Check compressed payloads keep their codec."""
+        if codec.msgpack is None:
+            raise SkipTest("msgpack is not installed")
+        data = dict(("key%d" % i, "value %d" % i) for i in range(10000))
+        payload = utils.serialize(data, "msgpack")
+        self.assertEqual(payload[0], codec.COMPRESSED)
+        self.assertEqual(codec.detect(payload).name, "msgpack")
+        self.assertEqual(utils.unserialize(payload), data)
@@ -133,6 +133,43 @@ class TestConfJSON(TempDirectoryTestCase):
         a = os.stat(name)
         self.assertEqual(a.st_mode & 0777, 0640)
 
+    def test_json_no_read_when_unchanged(self):
+        """Check an unchanged object is not written nor read back."""
+        name = "%s/test.json" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"1": "2"})
+        before = os.stat(name)
+        with patch.object(a, "read") as read:
+            a.write({"1": "2"})
+            a.write({"1": "3"})
+            self.assertFalse(read.called)
+        self.assertNotEqual(os.stat(name).st_ino, before.st_ino)
+        self.assertEqual(a.read(), {"1": "3"})
+
+    def test_json_modified_outside(self):
+        """Check a file modified by someone else is compared again."""
+        name = "%s/test.json" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"1": "2"})
+        with open(name, "w") as f:
+            f.write('{"1": "something else"}')
+        a.write({"1": "2"})
+        self.assertEqual(a.read(), {"1": "2"})
+        with open(name, "w") as f:
+            f.write('{"1":    "2"}')
+        a.write({"1": "2"})
+        with open(name) as f:
+            self.assertEqual(f.read(), '{"1":    "2"}')
+
+    def test_json_removed_outside(self):
+        """Check a file removed by someone else is written again."""
+        name = "%s/test.json" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"1": "2"})
+        os.unlink(name)
+        a.write({"1": "2"})
+        self.assertEqual(a.read(), {"1": "2"})
+
 class TestConfYAML(TempDirectoryTestCase):
 
     def test_yaml_write_from_extension(self):
@@ -185,6 +222,45 @@ class TestConfYAML(TempDirectoryTestCase):
         with open(name) as f:
             self.assertEqual(f.read(), '{             "1": "2"}')
 
+    def test_yaml_no_read_when_unchanged(self):
+        """Check an unchanged object is not written nor read back."""
+        name = "%s/test.yaml" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"1": "2"})
+        with patch.object(a, "read") as read:
+            a.write({"1": "2"})
+            self.assertFalse(read.called)
+
+    def test_yaml_same_output_without_libyaml(self):
+        """Check the output does not depend on libyaml being available."""
+        obj = {u"db-1": {u"hostname": u"db-1", u"description": u"Donn\xe9es " * 20,
+                         u"enabled": u"1", u"weight": 10, u"tags": [u"a", u"b"]},
+               u"db-2": {u"multiline": u"a\nb\n", u"emoji": u"\U0001F600", u"nel": u"a\x85b"},
+               1: "cc"}
+        name = "%s/test.yaml" % self.tmpdir
+        a = conf.Conf(name)
+        a.write(obj)
+        with patch.object(conf, "CSafeDumper", None):
+            b = conf.Conf("%s/test2.yaml" % self.tmpdir)
+            b.write(obj)
+        with open(name) as f:
+            with open("%s/test2.yaml" % self.tmpdir) as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_yaml_read_is_safe(self):
+        """Check reading YAML does not construct arbitrary objects."""
+        name = "%s/test.yaml" % self.tmpdir
+        with open(name, "w") as f:
+            f.write("a: !!python/object/apply:os.getcwd []\n")
+        self.assertRaises(yaml.YAMLError, conf.Conf(name).read)
+
+    def test_yaml_read_legacy_tags(self):
+        """Check we can read string tags written by older versions."""
+        name = "%s/test.yaml" % self.tmpdir
+        with open(name, "w") as f:
+            f.write("a: !!python/str caf\xc3\xa9\nb: !!python/unicode c\n")
+        self.assertEqual(conf.Conf(name).read(), {"a": u"caf\xe9", "b": u"c"})
+
 class TestConfPHP(TempDirectoryTestCase):
 
     def test_php_write_from_extension(self):
@@ -255,6 +331,57 @@ class TestConfPHP(TempDirectoryTestCase):
             result = f.read()
             self.assertIn('"\xf0\x9f\x98\x8d"', result)
 
+    def test_php_write_float_and_null(self):
+        """Check we can handle floats and None."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name, "php")
+        a.write({"load": 0.25, "big": 1e22, "nothing": None, "list": [1.5, None], 3: "int key"})
+        with open(name) as f:
+            result = f.read()
+        self.assertIn('"load" => 0.25', result)
+        self.assertIn('"big" => 1e+22', result)
+        self.assertIn('"nothing" => null', result)
+        self.assertIn('array(1.5,null)', result)
+        self.assertIn('"3" => "int key"', result)
+
+    def test_php_dont_update_if_no_change(self):
+        """Check the file is not rewritten when the content is unchanged."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name, "php")
+        a.write({"1": "2", "3": {"4": [5, 6]}})
+        before = os.stat(name)
+        a.write({"3": {"4": [5, 6]}, "1": "2"})
+        # Another instance compares with the content of the file
+        conf.Conf(name, "php").write({"1": "2", "3": {"4": [5, 6]}})
+        self.assertEqual(os.stat(name).st_ino, before.st_ino)
+        self.assertEqual(os.listdir(self.tmpdir), ["test.php"])
+        a.write({"1": "3"})
+        self.assertNotEqual(os.stat(name).st_ino, before.st_ino)
+        with open(name) as f:
+            self.assertIn('"1" => "3"', f.read())
+
+    def test_php_no_tempfile_when_unchanged(self):
+        """Check no temporary file is left when the content is unchanged."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name, "php")
+        a.write({"1": "2"})
+        before = os.stat(name)
+        a.write({"1": "2"})
+        conf.Conf(name, "php").write({"1": "2"})
+        self.assertEqual(os.listdir(self.tmpdir), ["test.php"])
+        self.assertEqual(os.stat(name).st_ino, before.st_ino)
+
+    def test_php_modified_outside(self):
+        """Check a file modified by someone else is written again."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name, "php")
+        a.write({"1": "2"})
+        with open(name, "w") as f:
+            f.write("<?php return array();")
+        a.write({"1": "2"})
+        with open(name) as f:
+            self.assertIn('"1" => "2"', f.read())
+
 class TestConfDir(TempDirectoryTestCase):
 
     def test_dir_from_existence(self):
@@ -309,6 +436,52 @@ class TestConfDir(TempDirectoryTestCase):
         with open("%s/otherstuff/2" % self.tmpdir) as f:
             self.assertEqual(f.read(), "1111")
 
+    def test_dir_write_delta(self):
+        """Check only differences are applied on subsequent writes."""
+        a = conf.Conf(self.tmpdir)
+        a.write({"stuff": "12",
+                 "gone": "1",
+                 "otherstuff": {"1": "1221",
+                                "2": "1111"},
+                 "replaced": {"1": "1"}})
+        with patch("zkfarmer.conf.os.listdir", wraps=os.listdir) as listdir:
+            a.write({"stuff": "13",
+                     "otherstuff": {"1": "1221",
+                                    "3": {"4": "5"}},
+                     "replaced": "2"})
+            # Only the new "3" directory and the removal of "replaced"
+            self.assertEqual(listdir.call_count, 2)
+        self.assertEqual(a.read(),
+                         {"stuff": "13",
+                          "otherstuff": {"1": "1221",
+                                         "3": {"4": "5"}},
+                          "replaced": "2"})
+
+    def test_dir_write_modified_outside(self):
+        """Check the whole tree is rewritten when modified by someone else."""
+        a = conf.Conf(self.tmpdir)
+        a.write({"stuff": "12",
+                 "otherstuff": {"1": "1221"}})
+        with open("%s/otherstuff/intruder" % self.tmpdir, "w") as f:
+            f.write("1")
+        os.unlink("%s/stuff" % self.tmpdir)
+        a.write({"stuff": "12",
+                 "otherstuff": {"1": "1221"}})
+        self.assertEqual(a.read(),
+                         {"stuff": "12",
+                          "otherstuff": {"1": "1221"}})
+
+    def test_dir_write_caller_modifications(self):
+        """Check modifying the written object afterwards does not confuse the writer."""
+        a = conf.Conf(self.tmpdir)
+        obj = {"stuff": "12", "otherstuff": {"1": "1221"}}
+        a.write(obj)
+        obj["otherstuff"]["1"] = "1222"
+        a.write(obj)
+        self.assertEqual(a.read(),
+                         {"stuff": "12",
+                          "otherstuff": {"1": "1222"}})
+
 
 if __name__ == '__main__':
     unittest.main()
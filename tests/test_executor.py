@@ -0,0 +1,93 @@
+import unittest
+import tempfile
+import shutil
+import time
+
+from zkfarmer.executor import CommandExecutor
+
+class TestCommandExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output = "%s/output" % self.tmpdir
+        self.executors = []
+
+    def tearDown(self):
+        for executor in self.executors:
+            executor.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def executor(self, cmd, *args, **kwargs):
+        executor = CommandExecutor(cmd, *args, **kwargs)
+        self.executors.append(executor)
+        return executor
+
+    def runs(self):
+        try:
+            with open(self.output) as f:
+                return len(f.readlines())
+        except IOError:
+            return 0
+
+    def test_run(self):
+        """Check the command is executed in the background."""
+        e = self.executor("echo run >> %s" % self.output)
+        e.trigger()
+        self.assertTrue(e.wait(5))
+        self.assertEqual(self.runs(), 1)
+        stats = e.stats()
+        self.assertEqual(stats["runs"], 1)
+        self.assertEqual(stats["exit_codes"], {0: 1})
+        self.assertEqual(stats["last_exit_code"], 0)
+        self.assertTrue(stats["last_duration"] >= 0)
+
+    def test_non_blocking(self):
+        """Check triggering does not wait for the command."""
+        e = self.executor("sleep 0.5")
+        start = time.time()
+        e.trigger()
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertTrue(e.wait(5))
+
+    def test_coalesce(self):
+        """Check triggers received during a run lead to one more run."""
+        e = self.executor("echo run >> %s; sleep 0.3" % self.output)
+        e.trigger()
+        time.sleep(0.1)
+        for i in range(5):
+            e.trigger()
+        self.assertTrue(e.wait(5))
+        self.assertEqual(self.runs(), 2)
+        self.assertEqual(e.stats()["coalesced"], 4)
+
+    def test_min_interval(self):
+        """Check runs are spaced by the minimum interval."""
+        e = self.executor("echo run >> %s" % self.output, min_interval=0.5)
+        start = time.time()
+        e.trigger()
+        time.sleep(0.1)
+        e.trigger()
+        self.assertTrue(e.wait(5))
+        self.assertTrue(time.time() - start >= 0.5)
+        self.assertEqual(self.runs(), 2)
+
+    def test_timeout(self):
+        """Check a command running for too long is killed."""
+        e = self.executor("sleep 10", timeout=0.2)
+        e.trigger()
+        self.assertTrue(e.wait(5))
+        stats = e.stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["failures"], 1)
+        self.assertTrue(stats["last_duration"] < 5)
+
+    def test_failure(self):
+        """Check failures are counted by exit code."""
+        e = self.executor("exit 3")
+        e.trigger()
+        self.assertTrue(e.wait(5))
+        e.trigger()
+        self.assertTrue(e.wait(5))
+        stats = e.stats()
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["exit_codes"], {3: 2})
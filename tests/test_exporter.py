@@ -1,11 +1,13 @@
 import unittest
 import json
+import tempfile
+import shutil
 
 from zkfarmer.conf import ConfJSON
-from zkfarmer.watcher import ZkFarmExporter
+from zkfarmer.watcher import ZkFarmExporter, WatcherGroup
 from zkfarmer.utils import create_filter
 from kazoo.testing import KazooTestCase
-from mock import Mock
+from mock import Mock, patch
 
 class TestZkExporter(KazooTestCase):
 
@@ -14,6 +16,12 @@ class TestZkExporter(KazooTestCase):
     def setUp(self):
         KazooTestCase.setUp(self)
         self.conf = Mock(spec=ConfJSON)
+        self.tmpdir = None
+
+    def tearDown(self):
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir)
+        KazooTestCase.tearDown(self)
 
     def test_start_empty(self):
         """Test we get nothing when nothing is in ZooKeeper"""
@@ -67,6 +75,8 @@ class TestZkExporter(KazooTestCase):
         handler = Mock()
         z = ZkFarmExporter(self.client, "/services/db", self.conf, handler)
         z.loop(2, timeout=self.TIMEOUT)
+        handler.assert_called_once_with()
+        handler.reset_mock()
         self.client.set("/services/db/1.1.1.1",
                         json.dumps({"enabled": "0"}))
         z.loop(1, timeout=self.TIMEOUT)
@@ -92,6 +102,69 @@ class TestZkExporter(KazooTestCase):
         self.conf.write.assert_called_with({"2.2.2.2": {"enabled": "1", "weight": "20"},
                                             "4.4.4.4": {"enabled": "1", "weight": "30"}})
 
+    def test_pipelined_fetch(self):
+        """Test all nodes are fetched when more nodes than allowed in-flight requests"""
+        for i in range(10):
+            self.client.ensure_path("/services/db/10.0.0.%d" % i)
+            self.client.set("/services/db/10.0.0.%d" % i,
+                            json.dumps({"enabled": "1", "weight": "%d" % i}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, max_inflight=3)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with(dict(("10.0.0.%d" % i, {"enabled": "1", "weight": "%d" % i})
+                                                for i in range(10)))
+
+    def test_modify_znode_only_refetch_modified(self):
+        """Test a modification to a znode only refetches this znode"""
+        for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "0"}))
+        with patch.object(self.client, "get_children") as get_children:
+            with patch.object(self.client, "get", wraps=self.client.get) as get:
+                z.loop(1, timeout=self.TIMEOUT)
+        self.assertFalse(get_children.called)
+        self.assertEqual(get.call_count, 1)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"},
+                                            "2.2.2.2": {"enabled": "0"},
+                                            "3.3.3.3": {"enabled": "1"}})
+
+    def test_remove_znode(self):
+        """Test a removed znode gets noticed"""
+        for ip in ["1.1.1.1", "2.2.2.2"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.client.delete("/services/db/2.2.2.2")
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"}})
+
+    def test_several_farms(self):
+        """Test several farms can be exported from the same loop"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "1"}))
+        self.client.ensure_path("/services/web/2.2.2.2")
+        self.client.set("/services/web/2.2.2.2",
+                        json.dumps({"enabled": "0"}))
+        other = Mock(spec=ConfJSON)
+        group = WatcherGroup()
+        ZkFarmExporter(self.client, "/services/db", self.conf, group=group)
+        ZkFarmExporter(self.client, "/services/web", other, group=group)
+        group.loop(4, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"}})
+        other.write.assert_called_with({"2.2.2.2": {"enabled": "0"}})
+        self.client.set("/services/web/2.2.2.2",
+                        json.dumps({"enabled": "1"}))
+        group.loop(1, timeout=self.TIMEOUT)
+        other.write.assert_called_with({"2.2.2.2": {"enabled": "1"}})
+        self.assertEqual(self.conf.write.call_count, 1)
+
     def test_disconnect(self):
         """Test disconnection to ZooKeeper is handled correctly"""
         self.client.ensure_path("/services/db/1.1.1.1")
@@ -119,6 +192,122 @@ class TestZkExporter(KazooTestCase):
         z.loop(2, timeout=self.TIMEOUT)
         self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "2"}})
 
+    def _snapshot_farm(self):
+        for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        self.tmpdir = tempfile.mkdtemp()
+        snapshot = "%s/snapshot.json" % self.tmpdir
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, snapshot=snapshot)
+        z.loop(2, timeout=self.TIMEOUT)
+        return snapshot
+
+    def test_snapshot_warm_start(self):
+        """Test a restarted exporter only fetches nodes modified in the meantime"""
+        snapshot = self._snapshot_farm()
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "0"}))
+        self.client.delete("/services/db/3.3.3.3")
+        self.client.ensure_path("/services/db/4.4.4.4")
+        self.client.set("/services/db/4.4.4.4",
+                        json.dumps({"enabled": "1"}))
+        self.conf.reset_mock()
+        with patch.object(self.client, "get_async", wraps=self.client.get_async) as get_async:
+            z = ZkFarmExporter(self.client, "/services/db", self.conf, snapshot=snapshot)
+            z.loop(2, timeout=self.TIMEOUT)
+        self.assertEqual(sorted(call[0][0] for call in get_async.call_args_list),
+                         ["/services/db/2.2.2.2", "/services/db/4.4.4.4"])
+        expected = {"1.1.1.1": {"enabled": "1"},
+                    "2.2.2.2": {"enabled": "0"},
+                    "4.4.4.4": {"enabled": "1"}}
+        self.conf.write.assert_called_with(expected)
+        self.assertEqual(dict((name, node["info"]) for name, node
+                              in ConfJSON(snapshot).read()["nodes"].iteritems()),
+                         expected)
+        # Watches are set on nodes only checked against the snapshot
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "2"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with(dict(expected, **{"1.1.1.1": {"enabled": "2"}}))
+        z.stop()
+
+    def test_snapshot_throttled(self):
+        """Test the snapshot is saved once for several changes in a row"""
+        snapshot = self._snapshot_farm()
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, snapshot=snapshot,
+                           snapshot_interval=0.5)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.reset_mock()
+        with patch.object(z.snapshot, "write", wraps=z.snapshot.write) as write:
+            for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+                self.client.set("/services/db/%s" % ip,
+                                json.dumps({"enabled": "0"}))
+            z.loop(3, timeout=self.TIMEOUT)
+            self.assertEqual(self.conf.write.call_count, 3)
+            self.assertFalse(write.called)
+            z.loop(1, timeout=1)
+            self.assertEqual(write.call_count, 1)
+            z.stop()
+            self.assertEqual(write.call_count, 1)
+        self.assertEqual(set(node["info"]["enabled"] for node
+                             in ConfJSON(snapshot).read()["nodes"].itervalues()),
+                         set(["0"]))
+
+    def test_snapshot_saved_on_stop(self):
+        """Test a snapshot behind the last changes is saved when stopping"""
+        snapshot = self._snapshot_farm()
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, snapshot=snapshot,
+                           snapshot_interval=60)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "0"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertEqual(ConfJSON(snapshot).read()["nodes"]["1.1.1.1"]["info"],
+                         {"enabled": "1"})
+        z.stop()
+        self.assertEqual(ConfJSON(snapshot).read()["nodes"]["1.1.1.1"]["info"],
+                         {"enabled": "0"})
+
+    def test_snapshot_other_farm(self):
+        """Test a snapshot of another farm is ignored"""
+        snapshot = self._snapshot_farm()
+        self.client.ensure_path("/services/web/5.5.5.5")
+        self.client.set("/services/web/5.5.5.5",
+                        json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/web", self.conf, snapshot=snapshot)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"5.5.5.5": {"enabled": "1"}})
+
+    def test_snapshot_invalid(self):
+        """Test an invalid snapshot is ignored"""
+        snapshot = self._snapshot_farm()
+        with open(snapshot, "w") as f:
+            f.write("{}")
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, snapshot=snapshot)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"},
+                                            "2.2.2.2": {"enabled": "1"},
+                                            "3.3.3.3": {"enabled": "1"}})
+
+    def test_disconnect_only_fetch_modified(self):
+        """Test nodes are not fetched again after a disconnection unless modified"""
+        for ip in ["1.1.1.1", "2.2.2.2"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.expire_session()
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "0"}))
+        with patch.object(self.client, "get_async", wraps=self.client.get_async) as get_async:
+            z.loop(10, timeout=self.TIMEOUT)
+        self.assertEqual([call[0][0] for call in get_async.call_args_list],
+                         ["/services/db/2.2.2.2"])
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"},
+                                            "2.2.2.2": {"enabled": "0"}})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,6 @@
 import unittest
 
-from zkfarmer.utils import create_filter
+from zkfarmer.utils import create_filter, parse_filter, match_predicates
 
 class TestFilters(unittest.TestCase):
 
@@ -86,5 +86,39 @@ class TestFilters(unittest.TestCase):
         self.assertFalse(filter(dict(enable="0", mysql=dict(replication_delay="10"))))
         self.assertFalse(filter(dict(enable="1")))
 
+    def test_double_equal(self):
+        """Check `==' is accepted as an equality operator."""
+        filter = create_filter("enable==1")
+        self.assertTrue(filter(dict(enable="1")))
+        self.assertFalse(filter(dict(enable="0")))
+
+    def test_non_numeric_values(self):
+        """Check non numeric values are compared as they are."""
+        filter = create_filter("role=master,weight>2")
+        self.assertTrue(filter(dict(role="master", weight="10")))
+        self.assertFalse(filter(dict(role="slave", weight="10")))
+        self.assertFalse(filter(dict(role="master", weight="1", other=None)))
+        self.assertFalse(filter(dict(role={"nested": "master"}, weight="10")))
+        self.assertTrue(filter(dict(role="master", weight=3)))
+
+    def test_malformed_filters(self):
+        """Check malformed filters are rejected up front."""
+        for f in ["=1", ">5", "!", "enable=1,,weight>2", "enable=1,", "!enable=1"]:
+            self.assertRaises(ValueError, create_filter, f)
+
+    def test_same_as_match_predicates(self):
+        """Check compiled filters agree with match_predicates."""
+        nodes = [dict(enable="1", weight="21", mysql=dict(delay="3")),
+                 dict(enable="0", weight=5, mysql=dict(delay=30)),
+                 dict(enable=True, weight="abc", mysql="none"),
+                 dict(enable=1.7, mysql=None),
+                 dict()]
+        for f in ["enable=1", "weight>=20", "weight<abc", "mysql.delay<10",
+                  "!mysql.delay", "mysql", "enable!=0,weight>4", "mysql.delay.x"]:
+            filter = create_filter(f)
+            for node in nodes:
+                self.assertEqual(filter(node), match_predicates(parse_filter(f), node),
+                                 "%s on %r" % (f, node))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,13 @@
 import unittest
 import json
+import tempfile
+import shutil
 from nose.plugins.skip import SkipTest
 
 from zkfarmer.conf import ConfJSON
 from zkfarmer.watcher import ZkFarmJoiner, ZkFarmImporter
 from zkfarmer.utils import create_filter
+from zkfarmer import codec, metrics
 from kazoo.testing import KazooTestCase
 from mock import Mock, patch
 
@@ -32,6 +35,7 @@ class TestZkImporter(KazooTestCase):
         super(TestZkImporter, self).setUp()
         self.conf = Mock(spec=ConfJSON)
         self.conf.file_path = "/fake/root"
+        self.tmpdir = None
 
         self._compat_cleanups = []
 
@@ -60,6 +64,8 @@ class TestZkImporter(KazooTestCase):
             except:
                 # To complex to implement correctly.
                 pass
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir)
         return super(TestZkImporter, self).tearDown()
 
     def test_initialize_observer(self):
@@ -67,9 +73,18 @@ class TestZkImporter(KazooTestCase):
         self.conf.read.return_value = {}
         z = self.Z(self.client, "/services/db", self.conf)
         z.loop(3, timeout=self.TIMEOUT)
-        self.mock_observer.schedule.assert_called_once_with(z, path="/fake", recursive=True)
+        self.mock_observer.schedule.assert_called_once_with(z, path="/fake", recursive=False)
         self.mock_observer.start.assert_called_once_with()
 
+    def test_initialize_observer_dir(self):
+        """Test if a configuration directory is watched recursively"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.conf.file_path = self.tmpdir
+        self.conf.read.return_value = {}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.mock_observer.schedule.assert_called_once_with(z, path=self.tmpdir, recursive=True)
+
     def test_initial_set(self):
         """Check if znode is correctly created into ZooKeeper"""
         self.conf.read.return_value = {"enabled": "1",
@@ -80,6 +95,19 @@ class TestZkImporter(KazooTestCase):
                          {"enabled": "1",
                           "hostname": self.NAME})
 
+    def test_initial_set_farm_codec(self):
+        """Check the znode is encoded with the codec of the farm"""
+        if codec.msgpack is None:
+            raise SkipTest("msgpack is not installed")
+        self.client.ensure_path("/services/db")
+        self.client.set("/services/db", json.dumps({"codec": "msgpack"}))
+        self.conf.read.return_value = {"enabled": "1"}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        data = self.client.get("/services/db/%s" % self.IP)[0]
+        self.assertEqual(codec.detect(data).name, "msgpack")
+        self.assertEqual(codec.decode(data)["enabled"], "1")
+
     def test_initial_set_ephemereal(self):
         """Check if created znode is ephemereal"""
         self.conf.read.return_value = {"enabled": "1",
@@ -131,6 +159,68 @@ class TestZkImporter(KazooTestCase):
                          {"enabled": "57",
                           "hostname": self.NAME})
 
+    def test_ignore_unrelated_files(self):
+        """Test changes of files next to the configuration are ignored"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.reset_mock()
+        for path in ["/fake/root.swp", "/fake/tmpYhcQ2s", "/fake"]:
+            f = FakeFileEvent()
+            f.src_path = path
+            z.dispatch(f)
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertFalse(self.conf.read.called)
+
+    def test_local_unchanged(self):
+        """Test ZooKeeper is not queried when the configuration did not change"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        client = metrics.InstrumentedClient(self.client)
+        z = self.Z(client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        client.requests.clear()
+        z.dispatch(FakeFileEvent())
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertTrue(self.conf.read.called)
+        self.assertEqual(client.requests, {})
+
+    def test_local_modification_requests(self):
+        """Check a local modification is written without reading the znode"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        client = metrics.InstrumentedClient(self.client)
+        z = self.Z(client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        client.requests.clear()
+        z.dispatch(FakeFileEvent())
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertEqual(client.requests, {"set": 1})
+        self.assertEqual(json.loads(self.client.get("/services/db/%s" % self.IP)[0]),
+                         {"enabled": "0",
+                          "hostname": self.NAME})
+
+    def test_local_modification_after_remote_modification(self):
+        """Check a local modification is written over a concurrent remote one"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        client = metrics.InstrumentedClient(self.client)
+        z = self.Z(client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.client.set("/services/db/%s" % self.IP,
+                        json.dumps({"enabled": "2",
+                                    "hostname": self.NAME}))
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        z.dispatch(FakeFileEvent())
+        z.loop(4, timeout=self.TIMEOUT)
+        self.assertEqual(json.loads(self.client.get("/services/db/%s" % self.IP)[0]),
+                         {"enabled": "0",
+                          "hostname": self.NAME})
+
     def test_zookeeper_modification(self):
         """Check if local configuration is *NOT* updated after remote modification"""
         self.conf.read.return_value = {"enabled": "1",
@@ -273,6 +363,43 @@ class TestZkJoiner(TestZkImporter):
         self.conf.write.assert_called_once_with({"enabled": "0",
                                                  "hostname": self.NAME})
 
+    def test_zookeeper_modification_not_sent_back(self):
+        """Check the local write of a remote modification is not sent back"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        client = metrics.InstrumentedClient(self.client)
+        z = ZkFarmJoiner(client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.client.set("/services/db/%s" % self.IP,
+                        json.dumps({"enabled": "0",
+                                    "hostname": self.NAME}))
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        client.requests.clear()
+        z.dispatch(FakeFileEvent())
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertEqual(client.requests, {})
+
+    def test_debounce(self):
+        """Check a burst of local modifications is handled once"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        client = metrics.InstrumentedClient(self.client)
+        z = self.Z(client, "/services/db", self.conf, debounce=0.05)
+        z.loop(3, timeout=self.TIMEOUT)
+        client.requests.clear()
+        for enabled in ["2", "3", "4"]:
+            self.conf.read.return_value = {"enabled": enabled,
+                                           "hostname": self.NAME}
+            z.dispatch(FakeFileEvent())
+            z.loop(1, timeout=0.01)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertEqual(client.requests["set"], 1)
+        self.assertEqual(json.loads(self.client.get("/services/db/%s" % self.IP)[0]),
+                         {"enabled": "4",
+                          "hostname": self.NAME})
+
     def test_updated_handler_called(self):
         """Test the appropriate handler is called on modification"""
         self.conf.read.return_value = {"enabled": "1",
@@ -414,9 +541,9 @@ class TestZkJoiner(TestZkImporter):
                                             "maintainance": "2"})
         # Check the node exists
         n = self.client.get("/services/db/common")
-        self.assertEqual(n[0],
-                         json.dumps({"enabled": "1",
-                                     "maintainance": "2"}))
+        self.assertEqual(json.loads(n[0]),
+                         {"enabled": "1",
+                          "maintainance": "2"})
         self.assertEqual(n[1].ephemeralOwner, 0)
 
     def test_common_node_join_when_local_modifications(self):
@@ -0,0 +1,146 @@
+import unittest
+import json
+import tempfile
+import shutil
+import urllib2
+
+from zkfarmer import metrics
+from zkfarmer.conf import ConfJSON
+from zkfarmer.watcher import CoalescingQueue, ZkFarmExporter
+from kazoo.testing import KazooTestCase
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.enabled, metrics.enabled = metrics.enabled, True
+
+    def tearDown(self):
+        metrics.enabled = self.enabled
+
+    def test_counter(self):
+        """Check counters are rendered with their labels"""
+        c = metrics.Counter("test_total", "Some help", ["op"], registry=self.registry)
+        c.inc(op="get")
+        c.inc(2, op="get")
+        c.inc(op='"set"')
+        self.assertEqual(c.get(op="get"), 3)
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_total Some help\n'
+                         '# TYPE test_total counter\n'
+                         'test_total{op="\\"set\\""} 1\n'
+                         'test_total{op="get"} 3\n')
+        self.assertRaises(ValueError, c.inc, other="get")
+
+    def test_histogram(self):
+        """Check histograms have cumulative buckets"""
+        h = metrics.Histogram("test_seconds", "Some help", buckets=(0.5, 1), registry=self.registry)
+        h.observe(0.25)
+        h.observe(0.75)
+        h.observe(5)
+        self.assertEqual(h.get(), (3, 6.0))
+        self.assertEqual(self.registry.render().splitlines()[2:],
+                         ['test_seconds_bucket{le="0.5"} 1',
+                          'test_seconds_bucket{le="1"} 2',
+                          'test_seconds_bucket{le="+Inf"} 3',
+                          'test_seconds_sum 6.0',
+                          'test_seconds_count 3'])
+
+    def test_collected(self):
+        """Check collected gauges are computed from the sources at each rendering"""
+        g = metrics.Gauge("test_depth", "Some help", collected=True, registry=self.registry)
+        class Source(object):
+            depth = 2
+            def collect_metrics(self):
+                g.inc(self.depth)
+        sources = [Source(), Source()]
+        for source in sources:
+            self.registry.add_source(source)
+        self.assertTrue("test_depth 4\n" in self.registry.render())
+        del sources[1], source
+        self.assertTrue("test_depth 2\n" in self.registry.render())
+        self.registry.remove_source(sources[0])
+        self.assertEqual(self.registry.render().splitlines()[2:], [])
+
+    def test_queue(self):
+        """Check queue depth, latency and coalesced events are recorded"""
+        coalesced = metrics.events_coalesced.get() or 0
+        q = CoalescingQueue()
+        q.put(((2, 1), "event", ()))
+        q.put(((2, 2), "event", ()))
+        q.put(((1, 3), "urgent", ()))
+        self.assertEqual(metrics.events_coalesced.get(), coalesced + 1)
+        metrics.REGISTRY.render()
+        self.assertTrue(metrics.queue_depth.get(priority=2) >= 1)
+        count, _ = metrics.event_latency.get(priority=1) or (0, 0)
+        q.get()
+        self.assertTrue(q.last_wait >= 0)
+        self.assertEqual(metrics.event_latency.get(priority=1)[0], count + 1)
+
+    def test_http(self):
+        """Check metrics are served over HTTP"""
+        server = metrics.start_http_server(0, '127.0.0.1')
+        try:
+            body = urllib2.urlopen("http://127.0.0.1:%d/metrics" % server.server_port).read()
+        finally:
+            server.shutdown()
+        self.assertTrue("# TYPE zkfarmer_events_total counter" in body)
+
+    def test_file(self):
+        """Check metrics are written to a file"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            metrics.write_file("%s/zkfarmer.prom" % tmpdir)
+            with open("%s/zkfarmer.prom" % tmpdir) as f:
+                self.assertTrue("# TYPE zkfarmer_queue_depth gauge" in f.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestWatcherMetrics(KazooTestCase):
+
+    def setUp(self):
+        KazooTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.enabled, metrics.enabled = metrics.enabled, True
+        metrics.REGISTRY.reset()
+
+    def tearDown(self):
+        metrics.enabled = self.enabled
+        shutil.rmtree(self.tmpdir)
+        KazooTestCase.tearDown(self)
+
+    def test_exporter(self):
+        """Check the exporter records its events, requests, watches and writes"""
+        for ip in ["1.1.1.1", "2.2.2.2"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip, json.dumps({"enabled": "1"}))
+        events = metrics.events.get(watcher="ZkFarmExporter", event="children modified") or 0
+        requests = (metrics.zk_latency.get(op="get_children") or (0, 0))[0]
+        written = metrics.conf_written_bytes.get(conf="ConfJSON") or 0
+        conf = ConfJSON("%s/db.json" % self.tmpdir)
+        z = ZkFarmExporter(metrics.InstrumentedClient(self.client), "/services/db", conf)
+        z.loop(2, timeout=0.1)
+        self.assertEqual(metrics.events.get(watcher="ZkFarmExporter", event="children modified"),
+                         events + 1)
+        self.assertEqual(metrics.zk_latency.get(op="get_children")[0], requests + 1)
+        self.assertTrue(metrics.transition_duration.get(watcher="ZkFarmExporter",
+                                                        event="children modified")[0] >= 1)
+        self.assertEqual(metrics.conf_written_bytes.get(conf="ConfJSON") - written,
+                         conf.bytes_written)
+        self.assertTrue(conf.bytes_written > 0)
+        metrics.REGISTRY.render()
+        self.assertEqual(metrics.farm_nodes.get(farm="/services/db"), 2)
+        self.assertTrue(metrics.watches.get(state="armed") >= 2)
+        z.stop()
+        metrics.REGISTRY.render()
+        self.assertEqual(metrics.farm_nodes.get(farm="/services/db"), None)
+
+    def test_disabled(self):
+        """Check nothing is recorded for the events unless enabled"""
+        metrics.enabled = False
+        self.client.ensure_path("/services/db")
+        events = metrics.events.get(watcher="ZkFarmExporter", event="initial setup")
+        z = ZkFarmExporter(self.client, "/services/db", ConfJSON("%s/db.json" % self.tmpdir))
+        z.loop(1, timeout=0.1)
+        self.assertEqual(z.state, "idle")
+        self.assertEqual(metrics.events.get(watcher="ZkFarmExporter", event="initial setup"), events)
@@ -0,0 +1,68 @@
+import unittest
+from nose.plugins.skip import SkipTest
+
+from zkfarmer import table
+from zkfarmer.utils import create_filter
+
+NODES = {"1.1.1.1": {"enabled": "1", "weight": "10", "mysql": {"replication_delay": "0"}},
+         "2.2.2.2": {"enabled": "0", "weight": 20, "mysql": {"replication_delay": "12"}},
+         "3.3.3.3": {"enabled": "1", "weight": "abc", "maintenance": "1"},
+         "4.4.4.4": {"enabled": True, "weight": 2.7, "mysql": {"replication_delay": None}},
+         "5.5.5.5": {}}
+
+class TestFarmTable(unittest.TestCase):
+
+    def setUp(self):
+        if table.numpy is None:
+            raise SkipTest("NumPy is not available")
+        self.table = table.FarmTable(NODES)
+
+    def test_columns(self):
+        """Check each field is stored as a column"""
+        self.assertEqual(self.table.names, sorted(NODES))
+        self.assertEqual(list(self.table.column("enabled")), ["1", "0", "1", True, None])
+
+    def test_select(self):
+        """Check selected nodes are the same than with create_filter"""
+        for f in ["enabled=1", "weight>5", "weight<=abc", "mysql.replication_delay<10",
+                  "mysql", "!mysql.replication_delay", "enabled=1,!maintenance", "unknown",
+                  "!unknown", "unknown=1", "enabled!=0", ""]:
+            filter = create_filter(f)
+            self.assertEqual(self.table.select(f),
+                             sorted(name for name, node in NODES.items() if filter(node)),
+                             "filter %r" % f)
+
+    def test_select_large_integers(self):
+        """Check integers are compared exactly, as with create_filter"""
+        nodes = {"a": {"ts": "1700000000000000001", "big": "100000000000000000000001"},
+                 "b": {"ts": "1700000000000000000", "big": "100000000000000000000000"},
+                 "c": {"ts": "abc", "big": 5, "list": [1, 2]},
+                 "d": {"ts": 1700000000000000002, "list": [3]}}
+        farm_table = table.FarmTable(nodes)
+        self.assertEqual(list(farm_table.column("list")), [None, None, [1, 2], [3]])
+        for f in ["ts>1700000000000000000", "ts=1700000000000000001", "ts<=1700000000000000001",
+                  "big>100000000000000000000000", "big<100000000000000000000001",
+                  "big>1", "ts>abc", "list"]:
+            filter = create_filter(f)
+            self.assertEqual(farm_table.select(f),
+                             sorted(name for name, node in nodes.items() if filter(node)),
+                             "filter %r" % f)
+
+    def test_stats(self):
+        """Check statistics are computed on numeric values"""
+        stats = self.table.stats(percentiles=(50,))
+        self.assertEqual(sorted(stats), ["enabled", "maintenance", "mysql.replication_delay", "weight"])
+        self.assertEqual(stats["mysql.replication_delay"],
+                         {"count": 2, "min": 0.0, "max": 12.0, "mean": 6.0, "p50": 6.0})
+        self.assertEqual(stats["weight"]["count"], 3)
+        self.assertEqual(stats["weight"]["max"], 20.0)
+
+    def test_stats_with_mask(self):
+        """Check statistics only consider selected nodes"""
+        stats = self.table.stats(["weight", "hostname"], (90,), self.table.mask("enabled=1"))
+        self.assertEqual(stats, {"weight": {"count": 2, "min": 2.7, "max": 10.0,
+                                            "mean": 6.35, "p90": 9.27},
+                                 "hostname": {"count": 0}})
+
+if __name__ == '__main__':
+    unittest.main()
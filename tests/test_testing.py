@@ -0,0 +1,116 @@
+import time
+import json
+
+from zkfarmer.testing import FakeZooKeeper, FakeKazooTestCase
+from zkfarmer.utils import pipelined_get
+from zkfarmer.watcher import ZkFarmExporter
+from zkfarmer.conf import ConfJSON
+from kazoo.client import KazooState
+from kazoo.protocol.states import EventType
+from kazoo.exceptions import NoNodeError, NodeExistsError, BadVersionError, ConnectionLoss
+from mock import Mock
+
+class TestFakeClient(FakeKazooTestCase):
+
+    def test_nodes(self):
+        """Check the basic operations on znodes"""
+        self.client.ensure_path("/services/db")
+        self.assertEqual(self.client.create("/services/db/1.1.1.1", "{}"), "/services/db/1.1.1.1")
+        self.assertRaises(NodeExistsError, self.client.create, "/services/db/1.1.1.1")
+        self.assertRaises(NoNodeError, self.client.create, "/services/web/1.1.1.1")
+        stat = self.client.set("/services/db/1.1.1.1", "{1}")
+        self.assertEqual(stat.version, 1)
+        self.assertRaises(BadVersionError, self.client.set, "/services/db/1.1.1.1", "{2}", version=0)
+        self.assertEqual(self.client.get("/services/db/1.1.1.1")[0], "{1}")
+        self.assertEqual(self.client.get_children("/services/db"), ["1.1.1.1"])
+        self.assertEqual(self.client.exists("/services/db").numChildren, 1)
+        self.client.delete("/services/db", recursive=True)
+        self.assertEqual(self.client.exists("/services/db"), None)
+        self.assertRaises(NoNodeError, self.client.get, "/services/db/1.1.1.1")
+
+    def test_watches(self):
+        """Check watches fire once"""
+        self.client.ensure_path("/services/db")
+        children, data = Mock(), Mock()
+        self.client.get_children("/services/db", watch=children)
+        self.client.exists("/services/db/1.1.1.1", watch=data)
+        self.client.create("/services/db/1.1.1.1")
+        self.client.create("/services/db/2.2.2.2")
+        self.assertEqual(children.call_count, 1)
+        self.assertEqual(children.call_args[0][0].type, EventType.CHILD)
+        self.assertEqual(data.call_args[0][0].type, EventType.CREATED)
+        self.client.set("/services/db/1.1.1.1", "{}")
+        self.assertEqual(data.call_count, 1)
+
+    def test_other_client(self):
+        """Check clients share the tree but not their watches"""
+        other = self.zookeeper.client()
+        other.start()
+        watch = Mock()
+        other.create("/node", ephemeral=True)
+        self.client.get("/node", watch=watch)
+        other.set("/node", "changed")
+        self.assertEqual(watch.call_count, 1)
+        other.stop()
+        self.assertEqual(self.client.exists("/node"), None)
+
+    def test_session_loss(self):
+        """Check ephemeral nodes and watches are lost with the session"""
+        listener, watch = Mock(), Mock()
+        self.client.add_listener(listener)
+        self.client.create("/ephemeral", ephemeral=True)
+        self.client.create("/persistent")
+        self.client.get("/persistent", watch=watch)
+        session = self.client.client_id
+        self.expire_session()
+        self.assertEqual([c[0][0] for c in listener.call_args_list],
+                         [KazooState.LOST, KazooState.CONNECTED])
+        self.assertNotEqual(self.client.client_id, session)
+        self.assertEqual(self.client.exists("/ephemeral"), None)
+        self.client.set("/persistent", "changed")
+        self.assertFalse(watch.called)
+
+    def test_connection_loss(self):
+        """Check requests fail while the connection is suspended"""
+        self.lose_connection()
+        self.assertRaises(ConnectionLoss, self.client.get, "/")
+        self.assertRaises(ConnectionLoss, self.client.get_async("/").get)
+        self.client.restore_connection()
+        self.client.get("/")
+
+    def test_requests(self):
+        """Check requests are counted per operation"""
+        self.client.ensure_path("/services/db")
+        self.client.get("/services/db")
+        self.client.get_async("/services/db").get()
+        self.assertRaises(NoNodeError, self.client.get, "/services/web")
+        self.assertEqual(self.client.requests, {"ensure_path": 1, "get": 2, "get_async": 1})
+
+    def test_latency(self):
+        """Check pipelined requests overlap"""
+        client = FakeZooKeeper().client(latency=lambda op: 0.05 if op == "get" else 0)
+        client.start()
+        try:
+            for i in range(20):
+                client.create("/%d" % i, str(i))
+            start = time.time()
+            client.get("/0")
+            self.assertTrue(time.time() - start >= 0.05)
+            start = time.time()
+            results = list(pipelined_get(client, ["/%d" % i for i in range(20)]))
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertEqual([data for _, (data, _) in results], [str(i) for i in range(20)])
+        finally:
+            client.stop()
+
+    def test_exporter(self):
+        """Check the exporter follows a farm stored in the fake"""
+        for ip in ["1.1.1.1", "2.2.2.2"]:
+            self.client.create("/services/db/%s" % ip, json.dumps({"enabled": "1"}), makepath=True)
+        conf = Mock(spec=ConfJSON)
+        z = ZkFarmExporter(self.client, "/services/db", conf)
+        z.loop(2, timeout=0.1)
+        conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"}, "2.2.2.2": {"enabled": "1"}})
+        self.client.set("/services/db/1.1.1.1", json.dumps({"enabled": "0"}))
+        z.loop(1, timeout=0.1)
+        conf.write.assert_called_with({"1.1.1.1": {"enabled": "0"}, "2.2.2.2": {"enabled": "1"}})
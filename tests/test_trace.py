@@ -0,0 +1,71 @@
+import unittest
+import json
+import tempfile
+import shutil
+import pstats
+
+from zkfarmer import trace, metrics
+from zkfarmer.conf import ConfJSON
+from zkfarmer.watcher import ZkFarmExporter
+from kazoo.testing import KazooTestCase
+from mock import Mock
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ring_buffer(self):
+        """Check only the most recent events are kept and dumped"""
+        t = trace.EventTrace(3)
+        for i in range(5):
+            t.record("Watcher", "event %d" % i, "idle", "idle", 0.1, 0.2, {"get": i})
+        self.assertEqual(t.dump("%s/trace" % self.tmpdir), 3)
+        with open("%s/trace" % self.tmpdir) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r["event"] for r in records], ["event 2", "event 3", "event 4"])
+        self.assertEqual(records[0]["requests"], {"get": 2})
+        t.resize(2)
+        self.assertEqual([r["event"] for r in t.records], ["event 3", "event 4"])
+
+    def test_profiler(self):
+        """Check the profile is written once stopped"""
+        def busy():
+            return sorted(range(1000))
+        p = trace.Profiler("%s/profile" % self.tmpdir)
+        p.toggle()
+        self.assertTrue(p.running)
+        busy()
+        p.toggle()
+        self.assertFalse(p.running)
+        stats = pstats.Stats("%s/profile" % self.tmpdir)
+        self.assertTrue([f for f in stats.stats if f[2] == "busy"])
+        p.stop()
+
+class TestWatcherTrace(KazooTestCase):
+
+    def setUp(self):
+        KazooTestCase.setUp(self)
+        self.enabled, trace.enabled = trace.enabled, True
+
+    def tearDown(self):
+        trace.enabled = self.enabled
+        KazooTestCase.tearDown(self)
+
+    def test_exporter(self):
+        """Check events are recorded with the requests they made"""
+        self.client.ensure_path("/services/trace/1.1.1.1")
+        self.client.set("/services/trace/1.1.1.1", json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(metrics.InstrumentedClient(self.client), "/services/trace",
+                           Mock(spec=ConfJSON))
+        z.loop(2, timeout=0.1)
+        records = list(trace.events.records)[-2:]
+        self.assertEqual([(r["watcher"], r["event"], r["from"], r["to"]) for r in records],
+                         [("ZkFarmExporter", "initial setup", "initial", "idle"),
+                          ("ZkFarmExporter", "children modified", "idle", "idle")])
+        self.assertEqual(records[1]["requests"], {"get_children": 1, "get_async": 1})
+        self.assertTrue(records[1]["wait"] >= 0)
+        self.assertTrue(records[1]["duration"] >= 0)
@@ -3,6 +3,7 @@ from mock import Mock, patch
 from socket import socket, AF_INET, SOCK_DGRAM
 
 from zkfarmer import utils
+from kazoo.exceptions import NoNodeError
 
 class TestUtils(unittest.TestCase):
 
@@ -24,6 +25,27 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(utils.unserialize(utils.serialize({1: "2", 3: {"4": "5"}})),
                          {"1": "2", "3": {"4": "5"}})
 
+    def test_pipelined_get(self):
+        """Check pipelined reads are bounded and returned in order"""
+        inflight = []
+        zkconn = Mock()
+        def get_async(path, watch=None):
+            self.assertTrue(len(inflight) < 2)
+            result = Mock()
+            def get():
+                inflight.remove(path)
+                if path == "/b":
+                    raise NoNodeError()
+                return ("data of %s" % path, None)
+            result.get.side_effect = get
+            inflight.append(path)
+            return result
+        zkconn.get_async.side_effect = get_async
+        self.assertEqual(list(utils.pipelined_get(zkconn, ["/a", "/b", "/c"], max_inflight=2)),
+                         [("/a", ("data of /a", None)),
+                          ("/b", None),
+                          ("/c", ("data of /c", None))])
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,142 @@
+import unittest
+import time
+import Queue
+
+from zkfarmer.watcher import CoalescingQueue, WatchRegistry, ZkFarmWatcher, ZkFarmExporter, ZkFarmJoiner
+
+class TestCoalescingQueue(unittest.TestCase):
+
+    def test_coalesce_identical_events(self):
+        """Check identical pending events are merged"""
+        q = CoalescingQueue()
+        q.put(((2, 1), "children modified", ()))
+        q.put(((2, 2), "node modified", ("/a",)))
+        q.put(((2, 3), "children modified", ()))
+        q.put(((2, 4), "node modified", ("/b",)))
+        q.put(((2, 5), "node modified", ("/a",)))
+        self.assertEqual([q.get(False)[1:] for i in range(3)],
+                         [("children modified", ()),
+                          ("node modified", ("/a",)),
+                          ("node modified", ("/b",))])
+        self.assertRaises(Queue.Empty, q.get, False)
+        self.assertEqual(q.coalesced, 2)
+
+    def test_no_coalesce_once_delivered(self):
+        """Check an event is queued again once the previous one has been delivered"""
+        q = CoalescingQueue()
+        q.put(((2, 1), "children modified", ()))
+        q.get(False)
+        q.put(((2, 2), "children modified", ()))
+        self.assertEqual(q.get(False)[1], "children modified")
+
+    def test_no_coalesce_urgent_events(self):
+        """Check urgent events are never merged"""
+        q = CoalescingQueue()
+        q.put(((1, 1), "connection lost", ()))
+        q.put(((1, 2), "connection recovered", ()))
+        q.put(((1, 3), "connection lost", ()))
+        self.assertEqual([q.get(False)[1] for i in range(3)],
+                         ["connection lost", "connection recovered", "connection lost"])
+
+    def test_unhashable_arguments(self):
+        """Check events with unhashable arguments are still queued"""
+        q = CoalescingQueue()
+        q.put(((2, 1), "something", ({},)))
+        q.put(((2, 2), "something", ({},)))
+        self.assertEqual(q.qsize(), 2)
+
+    def test_debounce(self):
+        """Check events are delayed until the debounce window is over"""
+        q = CoalescingQueue(debounce=0.2)
+        q.put(((2, 1), "children modified", ()))
+        self.assertRaises(Queue.Empty, q.get, True, 0.05)
+        q.put(((1, 2), "connection lost", ()))
+        self.assertEqual(q.get(True, 0.05)[1], "connection lost")
+        start = time.time()
+        self.assertEqual(q.get(True, 1)[1], "children modified")
+        self.assertTrue(time.time() - start > 0.1)
+
+    def test_debounce_max_delay(self):
+        """Check a continuous flow of events does not delay them forever"""
+        q = CoalescingQueue(debounce=0.1, max_delay=0.3)
+        start = time.time()
+        q.put(((2, 1), "children modified", ()))
+        while time.time() - start < 0.25:
+            q.put(((2, 2), "children modified", ()))
+            self.assertRaises(Queue.Empty, q.get, True, 0.05)
+        self.assertEqual(q.get(True, 1)[1], "children modified")
+        self.assertTrue(time.time() - start < 0.5)
+
+class TestWatchRegistry(unittest.TestCase):
+
+    def test_register(self):
+        """Check a path can only be registered once"""
+        r = WatchRegistry()
+        self.assertTrue(r.register("/a"))
+        self.assertFalse(r.register("/a"))
+        self.assertTrue("/a" in r)
+        self.assertEqual(r.state("/a"), WatchRegistry.PENDING)
+        r.discard("/a")
+        self.assertFalse("/a" in r)
+        self.assertTrue(r.register("/a"))
+
+    def test_counts(self):
+        """Check watch counts follow the state of each path"""
+        r = WatchRegistry()
+        for i in range(100000):
+            r.register("/farm/%d" % i)
+        for i in range(0, 100000, 2):
+            r.arm("/farm/%d" % i)
+        r.discard("/farm/0")
+        r.discard("/farm/1")
+        r.discard("/farm/unknown")
+        self.assertEqual(r.counts(), {WatchRegistry.PENDING: 49999,
+                                      WatchRegistry.ARMED: 49999})
+        self.assertEqual(len(r), 99998)
+        r.clear()
+        self.assertEqual(r.counts(), {WatchRegistry.PENDING: 0,
+                                      WatchRegistry.ARMED: 0})
+
+class TestTransitions(unittest.TestCase):
+
+    def test_compiled_transitions(self):
+        """Check the transition table is compiled with the most specific handler"""
+        self.assertEqual(ZkFarmExporter.TRANSITIONS[("node modified", "idle")],
+                         ("idle", ZkFarmExporter.exec_node_modified_from_idle.__func__))
+        self.assertEqual(ZkFarmExporter.TRANSITIONS[("node modified", "lost")],
+                         ("lost", ZkFarmExporter.exec_node_modified.__func__))
+        self.assertEqual(ZkFarmExporter.TRANSITIONS[("connection lost", "idle")],
+                         ("lost", None))
+        self.assertFalse(("children modified", "initial") in ZkFarmExporter.TRANSITIONS)
+
+    def test_inherited_handlers(self):
+        """Check handlers are resolved against the subclass"""
+        self.assertEqual(ZkFarmJoiner.TRANSITIONS[("znode modified", "idle")],
+                         ("idle", ZkFarmJoiner.exec_znode_modified_from_idle.__func__))
+
+    def test_duplicate_transition(self):
+        """Check several transitions from the same state are rejected"""
+        def define():
+            class Watcher(ZkFarmWatcher):
+                EVENTS = { "something": [("idle", "idle"),
+                                         ("idle", "lost")] }
+        self.assertRaises(ValueError, define)
+
+    def test_invalid_transition(self):
+        """Check malformed transitions are rejected"""
+        def define():
+            class Watcher(ZkFarmWatcher):
+                EVENTS = { "something": [("idle",)] }
+        self.assertRaises(ValueError, define)
+
+    def test_orphan_handler(self):
+        """Check handlers without a matching transition are rejected"""
+        def define():
+            class Watcher(ZkFarmWatcher):
+                EVENTS = { "something": [("idle", "idle")] }
+                def exec_something_from_lost(self):
+                    pass
+        self.assertRaises(ValueError, define)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,8 @@ from zkfarmer.zkfarmer import ZkFarmer
 from zkfarmer.utils import create_filter
 from kazoo.testing import KazooTestCase
 from kazoo.exceptions import BadVersionError
+from nose.plugins.skip import SkipTest
+from zkfarmer import table, codec
 
 class TestZkFarmer(KazooTestCase):
 
@@ -30,6 +32,23 @@ class TestZkFarmer(KazooTestCase):
         self.assertEqual(z.list("/child3/child4"), ["child5"])
         self.assertEqual(z.list("/child3/child4/child5"), [])
 
+    def test_nodes(self):
+        """Iterate over the nodes matching a filter."""
+        z = ZkFarmer(self.client)
+        for i in range(10):
+            self.client.ensure_path("/services/db/10.0.0.%d" % i)
+            self.client.set("/services/db/10.0.0.%d" % i,
+                            json.dumps({"enabled": str(i % 2), "weight": i}))
+        self.client.ensure_path("/services/db/common")
+        nodes = dict(z.nodes("/services/db", max_inflight=3))
+        self.assertEqual(len(nodes), 11)
+        self.assertEqual(nodes["common"], {})
+        self.assertEqual(nodes["10.0.0.3"], {"enabled": "1", "weight": 3})
+        self.assertEqual(sorted(z.nodes("/services/db", "enabled=1,weight>5")),
+                         [("10.0.0.7", {"enabled": "1", "weight": 7}),
+                          ("10.0.0.9", {"enabled": "1", "weight": 9})])
+        self.assertEqual(list(z.nodes("/nothing")), [])
+
     def test_get_inexistent_node(self):
         """Get a node which does not exist."""
         z = ZkFarmer(self.client)
@@ -97,6 +116,29 @@ class TestZkFarmer(KazooTestCase):
         self.assertEqual(json.loads(self.client.get("/something")[0]),
                          dict(enabled="1", maintainance="0", weight="10"))
 
+    def test_set_keeps_codec(self):
+        """Set a value on a node encoded with msgpack."""
+        if codec.msgpack is None:
+            raise SkipTest("msgpack is not installed")
+        z = ZkFarmer(self.client)
+        self.client.ensure_path("/something")
+        self.client.set("/something", codec.Codec("msgpack").encode(dict(enabled="1")))
+        z.set("/something", "weight", "10")
+        data = self.client.get("/something")[0]
+        self.assertEqual(codec.detect(data).name, "msgpack")
+        self.assertEqual(z.get("/something"), dict(enabled="1", weight="10"))
+
+    def test_set_large(self):
+        """Set a value making the node larger than the compression threshold."""
+        z = ZkFarmer(self.client)
+        self.client.ensure_path("/something")
+        z.set("/something", "enabled", "1")
+        z.set("/something", "blob", "x" * codec.COMPRESS_THRESHOLD)
+        data = self.client.get("/something")[0]
+        self.assertEqual(data[0], codec.COMPRESSED)
+        self.assertTrue(len(data) < 1024)
+        self.assertEqual(z.get("/something"),
+                         dict(enabled="1", blob="x" * codec.COMPRESS_THRESHOLD))
 
     def test_set_bad_version(self):
         """Set some value with a concurrent update."""
@@ -146,5 +188,82 @@ class TestZkFarmer(KazooTestCase):
         self.assertEqual(z.check("/something", "5")[0], z.STATUS_OK)
         self.assertEqual(z.check("/something", "4")[0], z.STATUS_CRITICAL)
 
+    def test_check_farms(self):
+        """Check status of several farms at once"""
+        z = ZkFarmer(self.client)
+        for farm, size, running in (("ok", 3, 3), ("failing", 5, 2), ("filtered", 3, 3)):
+            self.client.ensure_path("/services/%s" % farm)
+            for i in range(running):
+                self.client.create("/services/%s/node%d" % (farm, i),
+                                   json.dumps({"enabled": str(i % 2)}))
+            self.client.set("/services/%s" % farm, json.dumps({"size": size}))
+        self.client.set("/services/filtered", json.dumps({"size": 3, "running_filter": "enabled=1"}))
+        self.client.ensure_path("/services/invalid")
+        self.client.set("/services/invalid", json.dumps({"size": 3, "running_filter": "=1"}))
+        farms = ["/services/ok", "/services/failing", "/services/filtered",
+                 "/services/invalid"]
+        results = z.check_farms(farms, "2", "1")
+        self.assertEqual([farm for farm, _ in results], farms)
+        self.assertEqual([status for _, (status, _) in results],
+                         [z.STATUS_OK, z.STATUS_CRITICAL, z.STATUS_CRITICAL,
+                          z.STATUS_UNKNOWN])
+        self.assertEqual(results[2][1][1], "1/3 nodes running, 2 nodes failing, max allowed 2")
+        self.assertEqual(z.worst_status([s for _, (s, _) in results]), z.STATUS_CRITICAL)
+        self.assertEqual(z.worst_status([z.STATUS_OK, z.STATUS_UNKNOWN]), z.STATUS_UNKNOWN)
+        self.assertEqual(z.worst_status([]), z.STATUS_OK)
+
+    def test_export(self):
+        """Export a single farm"""
+        z = ZkFarmer(self.client)
+        with patch("zkfarmer.zkfarmer.ZkFarmExporter") as exporter:
+            with patch("zkfarmer.zkfarmer.WatcherGroup") as group:
+                z.export("/services/db", "conf", filters="enabled=1")
+        self.assertEqual(exporter.call_count, 1)
+        self.assertEqual(exporter.call_args[0][1:3], ("/services/db", "conf"))
+        self.assertTrue(group.return_value.loop.called)
+
+    def test_export_farms(self):
+        """Export several farms in the same event loop"""
+        z = ZkFarmer(self.client)
+        handler = object()
+        with patch("zkfarmer.zkfarmer.ZkFarmExporter") as exporter:
+            with patch("zkfarmer.zkfarmer.WatcherGroup") as group:
+                z.export_farms([("/services/db", "db"),
+                                ("/services/web", "web", {"updated_handler": handler})],
+                               debounce=1)
+        group.assert_called_once_with(1, None)
+        self.assertEqual([c[0][1:4] for c in exporter.call_args_list],
+                         [("/services/db", "db", None), ("/services/web", "web", handler)])
+        self.assertEqual(group.return_value.loop.call_count, 1)
+
+    def test_farms(self):
+        """Find the farms under a root znode"""
+        z = ZkFarmer(self.client)
+        for farm in ("/services/web", "/services/db/master", "/services/db/slave"):
+            self.client.ensure_path("%s/node1" % farm)
+            self.client.set(farm, json.dumps({"size": 1}))
+        self.client.ensure_path("/services/empty")
+        self.assertEqual(z.farms("/services"),
+                         ["/services/db/master", "/services/db/slave", "/services/web"])
+        self.assertEqual(z.farms("/services/web"), ["/services/web"])
+        self.assertEqual(z.farms("/nothing"), [])
+
+    def test_stats(self):
+        """Compute statistics on the nodes of a farm"""
+        if table.numpy is None:
+            raise SkipTest("NumPy is not available")
+        z = ZkFarmer(self.client)
+        self.client.ensure_path("/something/common")
+        self.client.set("/something/common", json.dumps({"weight": "1000"}))
+        for i in range(10):
+            self.client.ensure_path("/something/mysql%d" % i)
+            self.client.set("/something/mysql%d" % i,
+                            json.dumps({"enabled": ((i == 0) and "0" or "1"),
+                                        "weight": "%d" % (i+10)}))
+        stats = z.stats("/something", "enabled=1", ["weight"], (50,))
+        self.assertEqual(stats, {"nodes": 9,
+                                 "fields": {"weight": {"count": 9, "min": 11.0, "max": 19.0,
+                                                       "mean": 15.0, "p50": 15.0}}})
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,175 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Encoding of the payloads stored in znodes
+
+Plain JSON payloads carry no header, so that farms written by any
+version can still be read. Other formats are prefixed by a header byte
+which cannot start a JSON document and are detected when decoding.
+Large payloads are compressed and wrapped into an envelope with its
+own header byte.
+"""
+
+import json
+import zlib
+import logging
+
+from . import metrics
+
+try:
+    import ujson
+except ImportError:
+    # Optional, the standard library is used instead
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    # Only needed by farms using the `msgpack' codec
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Header of compressed payloads, followed by the zlib compressed payload
+COMPRESSED = '\x02'
+# Payloads larger than this (in bytes) are compressed
+COMPRESS_THRESHOLD = 64 * 1024
+
+
+class CodecBase(object):
+    name = None
+    header = ''
+
+    def _check(self):
+        """Raise RuntimeError when the codec cannot be used"""
+        pass
+
+    def encode(self, data):
+        raise NotImplementedError('%s.encode()' % self.__class__.__name__)
+
+    def decode(self, payload):
+        raise NotImplementedError('%s.decode()' % self.__class__.__name__)
+
+
+class CodecJSON(CodecBase):
+    name = 'json'
+
+    def encode(self, data):
+        if ujson is not None:
+            try:
+                return ujson.dumps(data)
+            except (OverflowError, TypeError):
+                pass
+        return json.dumps(data)
+
+    def decode(self, payload):
+        if ujson is not None:
+            try:
+                return ujson.loads(payload)
+            except ValueError:
+                pass
+        return json.loads(payload)
+
+
+class CodecMsgpack(CodecBase):
+    name = 'msgpack'
+    header = '\x01'
+
+    def _check(self):
+        if msgpack is None:
+            raise RuntimeError('msgpack is required by the msgpack codec')
+
+    def encode(self, data):
+        self._check()
+        return self.header + msgpack.packb(data, use_bin_type=False)
+
+    def decode(self, payload):
+        self._check()
+        return msgpack.unpackb(payload[1:], raw=False)
+
+
+CODECS = dict((codec.name, codec) for codec in (CodecJSON(), CodecMsgpack()))
+HEADERS = dict((codec.header, codec) for codec in CODECS.itervalues() if codec.header)
+
+
+def Codec(name=None):
+    """Return the codec registered as `name`, JSON by default"""
+    try:
+        codec = CODECS[name or 'json']
+    except KeyError:
+        raise ValueError('Unsupported codec: %s' % name)
+    codec._check()
+    return codec
+
+
+class CompressionStats(object):
+    """Counters about the compression of payloads"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.compressed = 0         # Payloads written compressed
+        self.incompressible = 0     # Payloads above the threshold left as is
+        self.decompressed = 0       # Compressed payloads read
+        self.raw_bytes = 0          # Size of the compressed payloads before compression
+        self.compressed_bytes = 0   # Size of the compressed payloads
+
+    @property
+    def ratio(self):
+        """Compressed size over raw size of the compressed payloads"""
+        if not self.raw_bytes:
+            return None
+        return float(self.compressed_bytes) / self.raw_bytes
+
+compression = CompressionStats()
+
+
+def compress(payload):
+    """Wrap `payload` into a compressed envelope if it makes it smaller"""
+    compressed = COMPRESSED + zlib.compress(payload)
+    if len(compressed) >= len(payload):
+        compression.incompressible += 1
+        metrics.codec_payloads.inc(result='incompressible')
+        return payload
+    compression.compressed += 1
+    compression.raw_bytes += len(payload)
+    compression.compressed_bytes += len(compressed)
+    metrics.codec_payloads.inc(result='compressed')
+    metrics.codec_bytes.inc(len(payload), stage='raw')
+    metrics.codec_bytes.inc(len(compressed), stage='compressed')
+    logger.debug("Compressed payload from %d to %d bytes", len(payload), len(compressed))
+    return compressed
+
+
+def decompress(payload):
+    """Unwrap a compressed envelope, other payloads are returned as is"""
+    if payload[:1] != COMPRESSED:
+        return payload
+    compression.decompressed += 1
+    metrics.codec_payloads.inc(result='decompressed')
+    return zlib.decompress(payload[1:])
+
+
+def encode(data, codec=None, compress_threshold=COMPRESS_THRESHOLD):
+    """Encode `data` with `codec`, compressing it above `compress_threshold` bytes"""
+    payload = Codec(codec).encode(data)
+    if compress_threshold is not None and len(payload) > compress_threshold:
+        payload = compress(payload)
+    return payload
+
+
+def detect(payload):
+    """Return the codec used to encode `payload`"""
+    if payload[:1] == COMPRESSED:
+        payload = zlib.decompress(payload[1:])
+    return HEADERS.get(payload[:1], CODECS['json'])
+
+
+def decode(payload):
+    payload = decompress(payload)
+    return HEADERS.get(payload[:1], CODECS['json']).decode(payload)
@@ -8,14 +8,60 @@
 import os
 import os.path
 import sys
+import re
 import shutil
 import json
 import yaml
 import contextlib
 import tempfile
+import hashlib
+import copy
+import logging
 
-# Prevent unstandard !!python/unicode prefixes
-yaml.add_representer(unicode, lambda dumper, value: dumper.represent_scalar(u'tag:yaml.org,2002:str', value))
+logger = logging.getLogger(__name__)
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper
+except ImportError:
+    # libyaml bindings are not available
+    from yaml import SafeLoader
+    CSafeDumper = None
+
+
+class YAMLLoader(SafeLoader):
+    pass
+
+# Files written by older versions may contain these tags
+YAMLLoader.add_constructor(u'tag:yaml.org,2002:python/str', YAMLLoader.construct_yaml_str)
+YAMLLoader.add_constructor(u'tag:yaml.org,2002:python/unicode', YAMLLoader.construct_yaml_str)
+
+# Characters libyaml does not emit like the pure Python emitter
+if sys.maxunicode > 0xffff:
+    LIBYAML_MISMATCH = re.compile(u'[\x85\U00010000-\U0010ffff]')
+else:
+    LIBYAML_MISMATCH = re.compile(u'[\x85\ud800-\udbff]')
+LIBYAML_MISMATCH_UTF8 = re.compile('\xc2\x85|[\xf0-\xf4]')
+
+
+def yaml_dumper(obj):
+    """Return the fastest dumper producing the same output as yaml.SafeDumper"""
+    if CSafeDumper is None:
+        return yaml.SafeDumper
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, unicode):
+            if LIBYAML_MISMATCH.search(value):
+                return yaml.SafeDumper
+        elif isinstance(value, str):
+            if LIBYAML_MISMATCH_UTF8.search(value):
+                return yaml.SafeDumper
+        elif isinstance(value, dict):
+            stack.extend(value.iterkeys())
+            stack.extend(value.itervalues())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return CSafeDumper
 
 
 def Conf(file, format=None):
@@ -56,6 +102,38 @@ class ConfBase(object):
 class ConfFile(ConfBase):
     def __init__(self, file_path):
         self.file_path = file_path
+        # Digest of the serialized content known to be in the file
+        # and identity of the file at that time
+        self.last_written = None
+        self.bytes_written = 0
+
+    def _identity(self, path=None):
+        """Identity of the current file, changing when it is modified"""
+        try:
+            st = os.stat(path or self.file_path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+    def _write_if_changed(self, obj, data):
+        """Write the serialized `data` unless the file already contains `obj`
+
+        The file is only read back to be compared with `obj` when it
+        has been modified outside of this object since the last write.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        if self.file_path != '-':
+            identity = self._identity()
+            if identity is not None:
+                if self.last_written is not None and self.last_written[1] == identity:
+                    if self.last_written[0] == digest:
+                        return
+                elif self.read() == obj:
+                    self.last_written = (digest, identity)
+                    return
+        with self.open(write=True) as fd:
+            fd.write(data)
+        self.last_written = (digest, self._identity())
 
     @contextlib.contextmanager
     def open(self, write=False):
@@ -72,15 +150,17 @@ class ConfFile(ConfBase):
             yield open(self.file_path, 'r')
             return
         tmp, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file_path)))
+        f = os.fdopen(tmp, "w")
         try:
             current_umask = os.umask(0)
             os.umask(current_umask)
             os.chmod(tmpname, 0666 & ~current_umask)
-            f = os.fdopen(tmp, "w")
             yield f
+            self.bytes_written += f.tell()
             f.close()
             os.rename(tmpname, self.file_path)
         except:
+            f.close()
             os.unlink(tmpname)
             raise
 
@@ -91,63 +171,143 @@ class ConfJSON(ConfFile):
                 return json.load(fd)
 
     def write(self, obj):
-        try:
-            if self.read() == obj:
-                return
-        except NotImplementedError:
-            pass
-        with self.open(write=True) as fd:
-            json.dump(obj, fd)
+        self._write_if_changed(obj, json.dumps(obj, sort_keys=True))
 
 
 class ConfYAML(ConfFile):
     def read(self):
         if os.path.exists(self.file_path):
             with self.open() as fd:
-                return yaml.load(fd)
+                return yaml.load(fd, Loader=YAMLLoader)
 
     def write(self, obj):
-        try:
-            if self.read() == obj:
-                return
-        except NotImplementedError:
-            pass
-        with self.open(write=True) as fd:
-            yaml.dump(obj, fd, default_flow_style=False, allow_unicode=True)
+        self._write_if_changed(obj, yaml.dump(obj, Dumper=yaml_dumper(obj),
+                                              default_flow_style=False, allow_unicode=True))
+
+
+class DigestWriter(object):
+    """Encode, hash and write unicode fragments to a file by chunks"""
+
+    def __init__(self, fd, chunk_size=1024):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.digest = hashlib.sha1()
+
+    def write(self, text):
+        self.buffer.append(text)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        data = u''.join(self.buffer).encode('utf-8', 'ignore')
+        self.buffer = []
+        self.digest.update(data)
+        self.fd.write(data)
+
+
+class Unchanged(Exception):
+    """The rendered content is already in the file"""
 
 
 class ConfPHP(ConfFile):
     meta = {u'"': u'\\"', u"\0": u"\\\0", u"\n": u"\\n", u"\\": u"\\\\"}
+    meta_re = re.compile(u'["\0\n\\\\]')
     indent = u'    '
 
     def _quotemeta(self, value):
-        return u''.join(self.meta.get(c, c) for c in value)
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'ignore')
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        return self.meta_re.sub(lambda match: self.meta[match.group()], value)
 
-    def _dump(self, value, lvl=0):
-        if type(value) == int:
-            return value
+    def _float(self, value):
+        if value != value:
+            return u'NAN'
+        elif value in (float('inf'), float('-inf')):
+            return u'INF' if value > 0 else u'-INF'
+        return unicode(repr(value))
+
+    def _dump(self, value, write, lvl=0):
+        if type(value) == bool:
+            write(u'true' if value else u'false')
+        elif isinstance(value, (int, long)):
+            write(unicode(value))
+        elif isinstance(value, float):
+            write(self._float(value))
+        elif value is None:
+            write(u'null')
         elif isinstance(value, (str, unicode)):
-            return u'"%s"' % self._quotemeta(value)
-        elif type(value) == bool:
-            if value:
-                return u'true'
-            return u'false'
+            write(u'"%s"' % self._quotemeta(value))
         elif type(value) == dict:
             indent = lvl * self.indent
-            body = u',\n'.join([u'%s"%s" => %s' % (indent + self.indent, self._quotemeta(key), self._dump(val, lvl + 1)) for key, val in value.items()])
-            return u'array\n%s(\n%s\n%s)' % (indent, body, indent)
+            write(u'array\n%s(\n' % indent)
+            for i, key in enumerate(sorted(value)):
+                write(u'%s%s"%s" => ' % (u',\n' if i else u'', indent + self.indent, self._quotemeta(key)))
+                self._dump(value[key], write, lvl + 1)
+            write(u'\n%s)' % indent)
         elif type(value) == list:
-            return u'array(%s)' % ','.join([unicode(self._dump(val)) for val in value])
+            write(u'array(')
+            for i, val in enumerate(value):
+                if i:
+                    write(u',')
+                self._dump(val, write)
+            write(u')')
         else:
             raise TypeError('php_dump: cannot serialize value: %s' % type(value))
 
+    def _file_digest(self):
+        digest = hashlib.sha1()
+        try:
+            with self.open() as fd:
+                for chunk in iter(lambda: fd.read(65536), ''):
+                    digest.update(chunk)
+        except IOError:
+            return None
+        return digest.hexdigest()
+
+    def _unchanged(self, digest, identity):
+        """Tell if the file already contains the content hashed by `digest`
+
+        PHP cannot be read back, the raw content of the file is hashed
+        instead when it has been modified outside of this object.
+        """
+        if identity is None:
+            return False
+        if self.last_written is None or self.last_written[1] != identity:
+            self.last_written = (self._file_digest(), identity)
+        return self.last_written[0] == digest
+
     def write(self, obj):
-        with self.open(write=True) as fd:
-            php = u'<?php return %s;' % self._dump(obj)
-            fd.write(php.encode("utf-8", "ignore"))
+        # The content is rendered once, into the temporary file, which
+        # is dropped instead of renamed when it is already in place
+        try:
+            with self.open(write=True) as fd:
+                writer = DigestWriter(fd)
+                writer.write(u'<?php return ')
+                self._dump(obj, writer.write)
+                writer.write(u';')
+                writer.flush()
+                digest = writer.digest.hexdigest()
+                if self.file_path != '-' and self._unchanged(digest, self._identity()):
+                    raise Unchanged()
+        except Unchanged:
+            return
+        if self.file_path != '-':
+            self.last_written = (digest, self._identity())
+
+
+class OutOfSync(Exception):
+    """The written tree has been modified by someone else"""
 
 
 class ConfDir(ConfFile):
+    def __init__(self, file_path):
+        super(ConfDir, self).__init__(file_path)
+        # Identity of each directory as left by the last write
+        self.dirs = {}
+
     def _parse(self, path):
         struct = {}
         for entry in os.listdir(path):
@@ -181,6 +341,7 @@ class ConfDir(ConfFile):
                             continue
                 with open(entry_path, 'w') as fd:
                     fd.write(val)
+                self.bytes_written += len(val)
             elif type(val) == dict:
                 if not os.path.isdir(entry_path):
                     try:
@@ -200,9 +361,76 @@ class ConfDir(ConfFile):
                     shutil.rmtree(entry_path)
                 else:
                     os.unlink(entry_path)
+        self.dirs[path] = self._identity(path)
+
+    def _apply(self, old, new, path):
+        """Apply the differences between `old` and `new` to `path`
+
+        Raise OutOfSync if a directory to be modified is not as we
+        left it.
+        """
+        changed = [key for key, val in new.iteritems()
+                   if key not in old or old[key] != val]
+        removed = [key for key in old if key not in new]
+        if not changed and not removed:
+            return
+        if self.dirs.get(path) != self._identity(path):
+            raise OutOfSync(path)
+
+        for key in changed:
+            entry_path = os.path.join(path, key)
+            val, previous = new[key], old.get(key)
+            if isinstance(val, (str, unicode, int)):
+                if type(previous) == dict:
+                    self._remove(entry_path)
+                with open(entry_path, 'w') as fd:
+                    fd.write(val)
+                self.bytes_written += len(val)
+            elif type(val) == dict:
+                if type(previous) == dict:
+                    self._apply(previous, val, entry_path)
+                    continue
+                if previous is not None:
+                    os.unlink(entry_path)
+                os.mkdir(entry_path)
+                self._dump(val, entry_path)
+            else:
+                raise TypeError('dir_dump: cannot serialize value: %s' % type(val))
+        for key in removed:
+            self._remove(os.path.join(path, key))
+        self.dirs[path] = self._identity(path)
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+            for known in self.dirs.keys():
+                if known == path or known.startswith(path + os.sep):
+                    del self.dirs[known]
+        else:
+            os.unlink(path)
 
     def read(self):
         return self._parse(self.file_path)
 
     def write(self, obj):
+        """Write `obj` as a directory tree
+
+        Only the differences with the previously written object are
+        applied. The whole tree is walked when it has been modified
+        outside of this object, as far as it can be noticed from the
+        directories involved in the change.
+        """
+        if type(obj) != dict:
+            raise TypeError('dir_dump: invalid obj type: %s' % type(obj))
+        if self.last_written is not None and \
+                self.dirs.get(self.file_path) == self._identity(self.file_path):
+            try:
+                self._apply(self.last_written, obj, self.file_path)
+                self.last_written = copy.deepcopy(obj)
+                return
+            except OutOfSync as e:
+                logger.info("%s modified outside of zkfarmer, rewriting the whole tree" % e)
+        self.last_written = None
+        self.dirs = {}
         self._dump(obj, self.file_path)
+        self.last_written = copy.deepcopy(obj)
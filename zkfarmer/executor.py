@@ -0,0 +1,168 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+import os
+import signal
+import subprocess
+import threading
+import time
+import logging
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CommandExecutor(object):
+    """Run a shell command in the background each time it is triggered
+
+    At most one run is in flight: triggers received while the command
+    is running (or waiting for `min_interval` seconds to elapse since
+    the start of the previous run) are collapsed into a single
+    follow-up run. A run lasting more than `timeout` seconds is killed
+    along with its children.
+    """
+
+    def __init__(self, cmd, min_interval=0, timeout=None):
+        self.cmd = cmd
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.pending = False
+        self.running = False
+        self.stopped = False
+        self.last_start = None
+        self.triggers = 0
+        self.coalesced = 0
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.exit_codes = {}
+        self.last_exit_code = None
+        self.last_duration = None
+        self.max_duration = 0
+        self.total_duration = 0
+        self.thread = threading.Thread(target=self._loop, name='executor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self):
+        self.trigger()
+
+    def trigger(self):
+        """Request a run of the command, never blocks"""
+        with self.condition:
+            self.triggers += 1
+            if self.pending:
+                self.coalesced += 1
+            self.pending = True
+            self.condition.notify_all()
+
+    def stop(self):
+        """Stop the executor once the current run, if any, is done"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def wait(self, timeout=None):
+        """Wait until no run is pending nor in flight, return False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.running:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stats(self):
+        """Exit code and latency statistics of the runs"""
+        with self.condition:
+            return {'triggers': self.triggers,
+                    'runs': self.runs,
+                    'coalesced': self.coalesced,
+                    'failures': self.failures,
+                    'timeouts': self.timeouts,
+                    'exit_codes': dict(self.exit_codes),
+                    'last_exit_code': self.last_exit_code,
+                    'last_duration': self.last_duration,
+                    'max_duration': self.max_duration,
+                    'mean_duration': self.total_duration / self.runs if self.runs else None}
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                if self.last_start is not None:
+                    delay = self.last_start + self.min_interval - time.time()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                self.pending = False
+                self.running = True
+                self.last_start = time.time()
+            try:
+                self._run()
+            finally:
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+
+    def _kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _run(self):
+        start = time.time()
+        timer = None
+        timed_out = []
+        try:
+            process = subprocess.Popen(self.cmd, shell=True, close_fds=True,
+                                       preexec_fn=os.setsid)
+            if self.timeout is not None:
+                def expire():
+                    timed_out.append(True)
+                    self._kill(process)
+                timer = threading.Timer(self.timeout, expire)
+                timer.daemon = True
+                timer.start()
+            code = process.wait()
+        except OSError as e:
+            logger.error("Cannot execute `%s': %s" % (self.cmd, e))
+            code = None
+        finally:
+            if timer is not None:
+                timer.cancel()
+        duration = time.time() - start
+        with self.condition:
+            self.runs += 1
+            self.exit_codes[code] = self.exit_codes.get(code, 0) + 1
+            self.last_exit_code = code
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+            self.total_duration += duration
+            if timed_out:
+                self.timeouts += 1
+            if code != 0:
+                self.failures += 1
+        metrics.command_duration.observe(duration)
+        metrics.command_runs.inc(result=timed_out and 'timeout' or code == 0 and 'ok' or 'failed')
+        if timed_out:
+            logger.warn("Killed `%s' after %.3fs" % (self.cmd, duration))
+        elif code != 0:
+            logger.warn("`%s' exited with %s after %.3fs" % (self.cmd, code, duration))
+        else:
+            logger.info("`%s' executed in %.3fs" % (self.cmd, duration))
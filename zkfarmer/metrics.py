@@ -0,0 +1,384 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Internal metrics exposed in the Prometheus text format
+
+Metrics are declared at the module level and updated in place. Gauges
+describing the current state of long lived objects (queue depth,
+registered watches) are collected when the metrics are rendered, from
+the sources registered with `REGISTRY.add_source()`.
+
+The watchers only update the metrics of their hot paths once `enable()`
+has been called, which the HTTP server and the file writer do.
+"""
+
+import os
+import time
+import tempfile
+import threading
+import weakref
+import contextlib
+import BaseHTTPServer
+import logging
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+
+
+def enable():
+    """Start recording the metrics updated for each event"""
+    global enabled
+    enabled = True
+
+
+# Upper bounds of the buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.sources = []       # weak references to the sources
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_source(self, source):
+        """Register an object whose `collect_metrics()` method updates the collected gauges"""
+        with self.lock:
+            self.sources.append(weakref.ref(source))
+
+    def remove_source(self, source):
+        with self.lock:
+            self.sources = [ref for ref in self.sources
+                            if ref() is not None and ref() is not source]
+
+    def reset(self):
+        """Forget all the values and sources, mostly useful for tests"""
+        with self.lock:
+            self.sources = []
+            for metric in self.metrics:
+                metric.reset()
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format"""
+        with self.lock:
+            for metric in self.metrics:
+                if metric.collected:
+                    metric.reset()
+            self.sources = [ref for ref in self.sources if ref() is not None]
+            for source in [ref() for ref in self.sources]:
+                if source is None:
+                    continue
+                try:
+                    source.collect_metrics()
+                except Exception:
+                    logger.exception("Cannot collect metrics from %r" % source)
+            lines = []
+            for metric in self.metrics:
+                lines.extend(metric.render())
+        return ''.join('%s\n' % line for line in lines)
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=(), collected=False, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collected = collected
+        self.lock = threading.Lock()
+        self.values = {}        # label values -> value
+        registry.register(self)
+
+    def _key(self, labels):
+        try:
+            return tuple([labels[name] for name in self.labels])
+        except KeyError:
+            self._validate(labels)
+
+    def _validate(self, labels):
+        """Check the labels, to be done before creating a new value"""
+        if sorted(labels) != sorted(self.labels):
+            raise ValueError('%s: expected labels %s, got %s' % (self.name, ', '.join(self.labels),
+                                                                 ', '.join(labels)))
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.labels, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels))
+
+    def _add(self, amount, labels):
+        key = self._key(labels)
+        with self.lock:
+            if key in self.values:
+                self.values[key] += amount
+            else:
+                self._validate(labels)
+                self.values[key] = amount
+
+    def samples(self):
+        """Yield the `(suffix, key, extra labels, value)` of each sample"""
+        for key, value in sorted(self.values.items()):
+            yield '', key, (), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        with self.lock:
+            samples = list(self.samples())
+        for suffix, key, extra, value in samples:
+            lines.append('%s%s%s %s' % (self.name, suffix, self._format_labels(key, extra),
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._add(amount, labels)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self._validate(labels)
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        self._add(amount, labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, **kwargs):
+        super(Histogram, self).__init__(name, help, labels, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self._validate(labels)
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            counts, _, _ = state = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        """Return the number and the sum of the observations"""
+        state = self.values.get(self._key(labels))
+        return state and (state[2], state[1])
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulated = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulated += n
+                yield '_bucket', key, [('le', _format_value(bound))], cumulated
+            yield '_sum', key, (), total
+            yield '_count', key, (), count
+
+
+# Watchers
+events = Counter('zkfarmer_events_total',
+                 'Events processed by the watchers',
+                 ['watcher', 'event'])
+event_latency = Histogram('zkfarmer_event_latency_seconds',
+                          'Time between an event being signaled and its transition',
+                          ['priority'])
+transition_duration = Histogram('zkfarmer_transition_duration_seconds',
+                                'Time spent executing the action of a transition',
+                                ['watcher', 'event'])
+events_coalesced = Counter('zkfarmer_events_coalesced_total',
+                           'Events merged with an identical pending event')
+queue_depth = Gauge('zkfarmer_queue_depth',
+                    'Events waiting to be processed',
+                    ['priority'], collected=True)
+connection_changes = Counter('zkfarmer_connection_changes_total',
+                             'Changes of the state of the ZooKeeper connection',
+                             ['state'])
+watches = Gauge('zkfarmer_watches',
+                'ZooKeeper watches registered by the watchers',
+                ['state'], collected=True)
+farm_nodes = Gauge('zkfarmer_farm_nodes',
+                   'Nodes known by the exporters',
+                   ['farm'], collected=True)
+
+# ZooKeeper
+zk_latency = Histogram('zkfarmer_zk_request_duration_seconds',
+                       'Duration of the ZooKeeper requests',
+                       ['op'])
+zk_errors = Counter('zkfarmer_zk_request_errors_total',
+                    'ZooKeeper requests which failed',
+                    ['op'])
+
+# Configuration
+conf_write_duration = Histogram('zkfarmer_conf_write_duration_seconds',
+                                'Time spent writing the local configuration',
+                                ['conf'])
+conf_written_bytes = Counter('zkfarmer_conf_written_bytes_total',
+                             'Bytes written to the local configuration',
+                             ['conf'])
+
+# Payloads
+codec_bytes = Counter('zkfarmer_codec_bytes_total',
+                      'Size of the compressed payloads before and after compression',
+                      ['stage'])
+codec_payloads = Counter('zkfarmer_codec_payloads_total',
+                         'Payloads above the compression threshold and compressed payloads read',
+                         ['result'])
+
+# Changed commands
+command_duration = Histogram('zkfarmer_changed_cmd_duration_seconds',
+                             'Duration of the changed commands')
+command_runs = Counter('zkfarmer_changed_cmd_runs_total',
+                       'Runs of the changed commands',
+                       ['result'])
+
+
+class InstrumentedClient(object):
+    """Proxy to a KazooClient recording the latency of its requests
+
+    `requests` counts the requests sent for each operation.
+    """
+
+    OPS = ('get', 'get_children', 'set', 'create', 'delete', 'exists', 'ensure_path')
+
+    def __init__(self, zkconn):
+        self.zkconn = zkconn
+        self.requests = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.zkconn, name)
+        if name in self.OPS:
+            return self._timed(name, attr)
+        if name.endswith('_async') and name[:-6] in self.OPS:
+            return self._timed_async(name[:-6], attr)
+        return attr
+
+    def _timed(self, op, func):
+        def timed(*args, **kwargs):
+            self.requests[op] = self.requests.get(op, 0) + 1
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                zk_errors.inc(op=op)
+                raise
+            finally:
+                zk_latency.observe(time.time() - start, op=op)
+        return timed
+
+    def _timed_async(self, op, func):
+        def timed(*args, **kwargs):
+            self.requests[op + '_async'] = self.requests.get(op + '_async', 0) + 1
+            start = time.time()
+            result = func(*args, **kwargs)
+            def done(result):
+                zk_latency.observe(time.time() - start, op=op)
+                if not result.successful():
+                    zk_errors.inc(op=op)
+            result.rawlink(done)
+            return result
+        return timed
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request from %s: %s" % (self.address_string(), format % args))
+
+
+def start_http_server(port, address=''):
+    """Serve the metrics over HTTP from a background thread"""
+    enable()
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_file(path):
+    """Atomically write the metrics to `path`"""
+    tmp, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(tmp, 'w') as f:
+            f.write(REGISTRY.render())
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, path)
+    except:
+        os.unlink(tmpname)
+        raise
+
+
+def start_file_writer(path, interval=15):
+    """Write the metrics to `path` every `interval` seconds from a background thread"""
+    enable()
+    def loop():
+        while True:
+            try:
+                write_file(path)
+            except (IOError, OSError) as e:
+                logger.warn("Cannot write metrics to %s: %s" % (path, e))
+            time.sleep(interval)
+    thread = threading.Thread(target=loop, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,51 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+import sys
+import time
+import logging
+from socket import gethostname
+
+logger = logging.getLogger(__name__)
+
+
+class PassiveResultWriter(object):
+    """Write check results as Nagios passive service check results
+
+    Results are appended as external commands to `path`, usually the
+    Nagios command pipe, or to the standard output when `path` is
+    None. The service description is `service` with `%s` replaced by
+    the path of the farm.
+    """
+
+    def __init__(self, path=None, host=None, service='%s'):
+        self.path = path
+        self.host = host or gethostname()
+        self.service = service
+
+    def __call__(self, zknode, status, reason):
+        self.write(zknode, status, reason)
+
+    def format(self, zknode, status, reason, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        return '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (timestamp, self.host,
+                                                                   self.service.replace('%s', zknode),
+                                                                   status, ' '.join(reason.splitlines()))
+
+    def write(self, zknode, status, reason):
+        line = self.format(zknode, status, reason)
+        if self.path is None:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            return
+        try:
+            # Opened for each result so that a recreated pipe is picked up
+            with open(self.path, 'a') as f:
+                f.write(line)
+        except IOError as e:
+            logger.error("Cannot write check result to %s: %s" % (self.path, e))
@@ -0,0 +1,175 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+import operator
+
+try:
+    import numpy
+except ImportError:
+    # Only needed for farm tables and the `stats' sub-command
+    numpy = None
+
+from .utils import parse_filter, compile_path
+
+
+class FarmTable(object):
+    """Columnar view of the nodes of a farm
+
+    Each field path (using dotted notation for nested fields) is
+    stored as a NumPy array with one cell per node, None when the
+    node does not have the field. Columns are only built when a
+    filter or a statistic needs them. Filters are evaluated as
+    boolean masks over the whole farm, with the same semantics as
+    `utils.create_filter`.
+    """
+
+    def __init__(self, nodes):
+        if numpy is None:
+            raise RuntimeError('NumPy is required to build a farm table')
+        self.names = sorted(nodes)
+        self.size = len(self.names)
+        self.nodes = [nodes[name] for name in self.names]
+        self.columns = {}
+        self._present = {}
+        self._ints = {}
+        self._numbers = {}
+
+    def paths(self):
+        """Sorted field paths of all the nodes"""
+        paths = set()
+        def walk(dicts, prefix):
+            for key in set().union(*dicts):
+                path = u'%s%s' % (prefix, key)
+                paths.add(path)
+                children = [d[key] for d in dicts if type(d.get(key)) == dict]
+                if children:
+                    walk(children, path + u'.')
+        walk(self.nodes, u'')
+        return sorted(paths)
+
+    def column(self, path):
+        """Values of `path` for each node, None when missing"""
+        if path not in self.columns:
+            get = compile_path(path)
+            values = [get(node) for node in self.nodes]
+            column = numpy.empty(self.size, dtype=object)
+            types = set(map(type, values))
+            if list in types or tuple in types:
+                # NumPy would take them as nested dimensions
+                for i, value in enumerate(values):
+                    column[i] = value
+            else:
+                column[:] = values
+            self.columns[path] = column
+        return self.columns[path]
+
+    def _convert(self, path, cache, convert, dtype):
+        """Return a (convertible mask, array) pair for a column
+
+        The present values are converted at once, falling back to a
+        conversion of each value when some are not convertible.
+        Integers not fitting `dtype` are kept as Python objects.
+        """
+        if path not in cache:
+            mask = numpy.zeros(self.size, dtype=bool)
+            values = numpy.zeros(self.size, dtype=dtype)
+            present = self.present(path)
+            if present.any():
+                column = self.column(path)[present]
+                try:
+                    values[present] = column.astype(dtype)
+                    mask = present
+                except (ValueError, TypeError, OverflowError):
+                    converted = []
+                    for value in column:
+                        try:
+                            converted.append(convert(value))
+                        except (ValueError, TypeError, OverflowError):
+                            converted.append(None)
+                    converted = numpy.array(converted, dtype=object)
+                    valid = numpy.not_equal(converted, None)
+                    mask[present] = valid
+                    try:
+                        values[mask] = converted[valid].astype(dtype)
+                    except OverflowError:
+                        values = values.astype(object)
+                        values[mask] = converted[valid]
+            cache[path] = (mask, values)
+        return cache[path]
+
+    def present(self, path):
+        """Mask of the nodes having a non null value for `path`"""
+        if path not in self._present:
+            self._present[path] = numpy.not_equal(self.column(path), None)
+        return self._present[path]
+
+    def numbers(self, path):
+        """Numeric values of `path`, NaN when missing or not a number"""
+        mask, values = self._convert(path, self._numbers, float, float)
+        values = values.copy()
+        values[~mask] = numpy.nan
+        return values
+
+    def _compare(self, op, column, value):
+        return numpy.asarray(op(column, value), dtype=bool)
+
+    def _predicate_mask(self, predicate):
+        path, op, value = predicate['path'], predicate['op'], predicate['value']
+        present = self.present(path)
+        if value is None:
+            return present.copy() if op is operator.is_not else ~present
+        result = numpy.zeros(self.size, dtype=bool)
+        try:
+            number = int(value)
+        except ValueError:
+            result[present] = self._compare(op, self.column(path)[present], value)
+            return result
+        isint, ints = self._convert(path, self._ints, int, numpy.int64)
+        result[isint] = op(ints[isint], number)
+        others = present & ~isint
+        if others.any():
+            result[others] = self._compare(op, self.column(path)[others], value)
+        return result
+
+    def mask(self, filters=None):
+        """Mask of the nodes matching a filter expression"""
+        result = numpy.ones(self.size, dtype=bool)
+        if filters:
+            for predicate in parse_filter(filters):
+                result &= self._predicate_mask(predicate)
+        return result
+
+    def select(self, filters=None):
+        """Names of the nodes matching a filter expression"""
+        return [name for name, selected in zip(self.names, self.mask(filters)) if selected]
+
+    def stats(self, fields=None, percentiles=(50, 90, 99), mask=None):
+        """Compute statistics for numeric fields
+
+        Return a dictionary mapping each field to its count, min, max,
+        mean and requested percentiles (as `pNN` keys). Only the nodes
+        selected by `mask` are considered. When `fields` is not given,
+        fields without any numeric value are omitted.
+        """
+        result = {}
+        for path in fields or self.paths():
+            values = self.numbers(path)
+            if mask is not None:
+                values = values[mask]
+            values = values[~numpy.isnan(values)]
+            if not len(values):
+                if fields:
+                    result[path] = {'count': 0}
+                continue
+            entry = {'count': int(len(values)),
+                     'min': float(values.min()),
+                     'max': float(values.max()),
+                     'mean': float(values.mean())}
+            for p, v in zip(percentiles, numpy.percentile(values, percentiles)):
+                entry['p%g' % p] = float(v)
+            result[path] = entry
+        return result
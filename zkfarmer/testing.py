@@ -0,0 +1,408 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""In-memory stand-in for ZooKeeper
+
+`FakeZooKeeper` holds a tree of znodes shared by the `FakeClient`
+objects connected to it. The clients implement the subset of
+`KazooClient` used by zkfarmer, with one-shot watches, connection
+listeners, ephemeral nodes and asynchronous requests, so that the
+watchers can be tested and benchmarked on large farms without a
+ZooKeeper server.
+
+Each request can be delayed to mimic the round trip to a server.
+Asynchronous requests are applied to the tree immediately but their
+result is only delivered once the latency elapsed, so pipelined
+requests overlap as they would over a real connection.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+import unittest
+
+from kazoo.handlers.threading import SequentialThreadingHandler
+from kazoo.protocol.states import ZnodeStat, WatchedEvent, EventType, KeeperState, KazooState
+from kazoo.exceptions import (NoNodeError, NodeExistsError, NotEmptyError, BadVersionError,
+                              ConnectionLoss)
+
+
+def _split(path):
+    parent, name = path.rsplit('/', 1)
+    return parent or '/', name
+
+
+class Znode(object):
+    __slots__ = ('data', 'czxid', 'mzxid', 'pzxid', 'ctime', 'mtime', 'version', 'cversion',
+                 'owner', 'children')
+
+    def __init__(self, data, zxid, owner=0):
+        self.data = data
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = int(time.time() * 1000)
+        self.version = self.cversion = 0
+        self.owner = owner
+        self.children = set()
+
+    def stat(self):
+        return ZnodeStat(self.czxid, self.mzxid, self.ctime, self.mtime, self.version,
+                         self.cversion, 0, self.owner, len(self.data), len(self.children),
+                         self.pzxid)
+
+
+class FakeZooKeeper(object):
+    """Tree of znodes shared by several clients"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.zxid = itertools.count(1)
+        self.sessions = itertools.count(1)
+        self.nodes = {'/': Znode('', next(self.zxid))}
+        self.clients = []
+
+    def client(self, **kwargs):
+        """Return a new client connected to this tree"""
+        return FakeClient(self, **kwargs)
+
+    def _fire(self, watches, path, type):
+        for client in list(self.clients):
+            client._fire(watches, path, type)
+
+    def create(self, path, value, owner, makepath):
+        with self.lock:
+            if path in self.nodes:
+                raise NodeExistsError(path)
+            parent, name = _split(path)
+            if parent not in self.nodes:
+                if not makepath:
+                    raise NoNodeError(parent)
+                self.create(parent, '', 0, True)
+            zxid = next(self.zxid)
+            self.nodes[path] = Znode(value, zxid, owner)
+            node = self.nodes[parent]
+            node.children.add(name)
+            node.cversion += 1
+            node.pzxid = zxid
+        self._fire('data', path, EventType.CREATED)
+        self._fire('child', parent, EventType.CHILD)
+        return path
+
+    def set(self, path, value, version):
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            if version != -1 and version != node.version:
+                raise BadVersionError(path)
+            node.data = value
+            node.mzxid = next(self.zxid)
+            node.mtime = int(time.time() * 1000)
+            node.version += 1
+            stat = node.stat()
+        self._fire('data', path, EventType.CHANGED)
+        return stat
+
+    def delete(self, path, version, recursive):
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            if version != -1 and version != node.version:
+                raise BadVersionError(path)
+            if node.children:
+                if not recursive:
+                    raise NotEmptyError(path)
+                for name in list(node.children):
+                    self.delete('%s/%s' % (path.rstrip('/'), name), -1, True)
+            del self.nodes[path]
+            parent, name = _split(path)
+            node = self.nodes[parent]
+            node.children.discard(name)
+            node.cversion += 1
+            node.pzxid = next(self.zxid)
+        self._fire('data', path, EventType.DELETED)
+        self._fire('child', path, EventType.DELETED)
+        self._fire('child', parent, EventType.CHILD)
+        return True
+
+    def expire(self, session):
+        """Remove the ephemeral nodes of `session`"""
+        with self.lock:
+            paths = [path for path, node in self.nodes.iteritems() if node.owner == session]
+        for path in sorted(paths, reverse=True):
+            try:
+                self.delete(path, -1, True)
+            except NoNodeError:
+                pass
+
+
+class FakeClient(object):
+    """In-memory replacement of `KazooClient`
+
+    `latency` is the delay of each request in seconds, or a function
+    returning the delay of the operation given as argument. `requests`
+    counts the requests sent for each operation, asynchronous ones
+    being suffixed by `_async` like in `metrics.InstrumentedClient`.
+
+    Watch callbacks and connection listeners are called from the
+    thread making the change, not from a dedicated thread as kazoo
+    does.
+    """
+
+    def __init__(self, tree=None, latency=0):
+        self.tree = tree or FakeZooKeeper()
+        self.latency = latency
+        self.handler = SequentialThreadingHandler()
+        self.state = KazooState.LOST
+        self.session_id = None
+        self.listeners = []
+        self.watches = {'data': {}, 'child': {}}
+        self.requests = {}
+        self.pending = []       # (due time, counter, async result, value, exception)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.delivery = None
+
+    @property
+    def connected(self):
+        return self.state == KazooState.CONNECTED
+
+    @property
+    def client_id(self):
+        return self.session_id and (self.session_id, '\0' * 16)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _set_state(self, state):
+        self.state = state
+        for listener in list(self.listeners):
+            listener(state)
+
+    def start(self, timeout=None):
+        if self.connected:
+            return
+        self.handler.start()
+        with self.tree.lock:
+            self.tree.clients.append(self)
+        self.session_id = next(self.tree.sessions)
+        self._set_state(KazooState.CONNECTED)
+
+    def stop(self):
+        if self.session_id is None:
+            return
+        with self.tree.lock:
+            if self in self.tree.clients:
+                self.tree.clients.remove(self)
+        self.tree.expire(self.session_id)
+        self.session_id = None
+        self.watches = {'data': {}, 'child': {}}
+        self._set_state(KazooState.LOST)
+        with self.cond:
+            self.cond.notify()
+        self.handler.stop()
+
+    def close(self):
+        pass
+
+    def lose_connection(self):
+        """Suspend the connection, requests fail until `restore_connection()`"""
+        self._set_state(KazooState.SUSPENDED)
+
+    def restore_connection(self):
+        self._set_state(KazooState.CONNECTED)
+
+    def expire_session(self):
+        """Expire the session and reconnect with a new one
+
+        Ephemeral nodes and watches of the session are lost.
+        """
+        self.tree.expire(self.session_id)
+        self.watches = {'data': {}, 'child': {}}
+        self._set_state(KazooState.LOST)
+        self.session_id = next(self.tree.sessions)
+        self._set_state(KazooState.CONNECTED)
+
+    def retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    # Watches
+
+    def _watch(self, kind, path, watch):
+        if watch is not None:
+            self.watches[kind].setdefault(path, set()).add(watch)
+
+    def _fire(self, kind, path, type):
+        watches = self.watches[kind].pop(path, ())
+        if watches:
+            event = WatchedEvent(type, KeeperState.CONNECTED, path)
+            for watch in watches:
+                watch(event)
+
+    # Requests
+
+    def _request(self, op):
+        self.requests[op] = self.requests.get(op, 0) + 1
+        if not self.connected:
+            raise ConnectionLoss()
+
+    def _delay(self, op):
+        return self.latency(op) if callable(self.latency) else self.latency
+
+    def _call(self, op, func, *args, **kwargs):
+        self._request(op)
+        delay = self._delay(op)
+        if delay:
+            time.sleep(delay)
+        return func(*args, **kwargs)
+
+    def _call_async(self, op, func, *args, **kwargs):
+        result = self.handler.async_result()
+        value = exception = None
+        try:
+            self._request(op + '_async')
+            value = func(*args, **kwargs)
+        except Exception as e:
+            exception = e
+        delay = self._delay(op)
+        if not delay:
+            if exception is not None:
+                result.set_exception(exception)
+            else:
+                result.set(value)
+            return result
+        with self.cond:
+            heapq.heappush(self.pending, (time.time() + delay, next(self.counter),
+                                          result, value, exception))
+            if self.delivery is None:
+                self.delivery = threading.Thread(target=self._deliver, name='fakezk')
+                self.delivery.daemon = True
+                self.delivery.start()
+            self.cond.notify()
+        return result
+
+    def _deliver(self):
+        """Set the results of the asynchronous requests once their latency elapsed"""
+        while True:
+            with self.cond:
+                while not self.pending or self.pending[0][0] > time.time():
+                    if self.session_id is None:
+                        self.delivery = None
+                        return
+                    self.cond.wait(max(self.pending[0][0] - time.time(), 0.001)
+                                   if self.pending else None)
+                _, _, result, value, exception = heapq.heappop(self.pending)
+            if exception is not None:
+                result.set_exception(exception)
+            else:
+                result.set(value)
+
+    def _exists(self, path, watch=None):
+        with self.tree.lock:
+            self._watch('data', path, watch)
+            node = self.tree.nodes.get(path)
+            return node and node.stat()
+
+    def _get(self, path, watch=None):
+        with self.tree.lock:
+            node = self.tree.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            self._watch('data', path, watch)
+            return node.data, node.stat()
+
+    def _get_children(self, path, watch=None, include_data=False):
+        with self.tree.lock:
+            node = self.tree.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            self._watch('child', path, watch)
+            if include_data:
+                return list(node.children), node.stat()
+            return list(node.children)
+
+    def _create(self, path, value='', acl=None, ephemeral=False, sequence=False, makepath=False):
+        if sequence:
+            with self.tree.lock:
+                parent = self.tree.nodes.get(_split(path)[0])
+                path = '%s%010d' % (path, parent.cversion if parent else 0)
+        return self.tree.create(path, value, ephemeral and self.session_id or 0, makepath)
+
+    def _ensure_path(self, path, acl=None):
+        path = path.rstrip('/') or '/'
+        try:
+            self.tree.create(path, '', 0, True)
+        except NodeExistsError:
+            pass
+        return True
+
+    def _set(self, path, value, version=-1):
+        return self.tree.set(path, value, version)
+
+    def _delete(self, path, version=-1, recursive=False):
+        return self.tree.delete(path, version, recursive)
+
+    def exists(self, *args, **kwargs):
+        return self._call('exists', self._exists, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self._call('get', self._get, *args, **kwargs)
+
+    def get_children(self, *args, **kwargs):
+        return self._call('get_children', self._get_children, *args, **kwargs)
+
+    def create(self, *args, **kwargs):
+        return self._call('create', self._create, *args, **kwargs)
+
+    def ensure_path(self, *args, **kwargs):
+        return self._call('ensure_path', self._ensure_path, *args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        return self._call('set', self._set, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._call('delete', self._delete, *args, **kwargs)
+
+    def exists_async(self, *args, **kwargs):
+        return self._call_async('exists', self._exists, *args, **kwargs)
+
+    def get_async(self, *args, **kwargs):
+        return self._call_async('get', self._get, *args, **kwargs)
+
+    def get_children_async(self, *args, **kwargs):
+        return self._call_async('get_children', self._get_children, *args, **kwargs)
+
+    def create_async(self, *args, **kwargs):
+        return self._call_async('create', self._create, *args, **kwargs)
+
+    def set_async(self, *args, **kwargs):
+        return self._call_async('set', self._set, *args, **kwargs)
+
+    def delete_async(self, *args, **kwargs):
+        return self._call_async('delete', self._delete, *args, **kwargs)
+
+
+class FakeKazooTestCase(unittest.TestCase):
+    """Drop-in replacement of `kazoo.testing.KazooTestCase`"""
+
+    def setUp(self):
+        self.zookeeper = FakeZooKeeper()
+        self.client = self.zookeeper.client()
+        self.client.start()
+
+    def tearDown(self):
+        self.client.stop()
+
+    def expire_session(self, *args):
+        self.client.expire_session()
+
+    def lose_connection(self, *args):
+        self.client.lose_connection()
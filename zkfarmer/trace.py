@@ -0,0 +1,109 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""On-demand profiling and event tracing of the watchers
+
+Once `enable()` has been called, the watchers record each processed
+event into `events`, a bounded ring buffer which can be dumped at any
+time. `profiler` runs cProfile
+around the event loop until it is stopped.
+"""
+
+import os
+import json
+import time
+import collections
+import cProfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+
+
+def enable():
+    """Start recording the events processed by the watchers"""
+    global enabled
+    enabled = True
+
+
+class EventTrace(object):
+    """Ring buffer of the most recent events processed by the watchers"""
+
+    def __init__(self, size=1000):
+        self.records = collections.deque(maxlen=size)
+
+    def resize(self, size):
+        self.records = collections.deque(self.records, maxlen=size)
+
+    def record(self, watcher, event, src, dst, wait, duration, requests=None, error=None):
+        self.records.append({'time': time.time(),
+                             'watcher': watcher,
+                             'event': event,
+                             'from': src,
+                             'to': dst,
+                             'wait': wait,
+                             'duration': duration,
+                             'requests': requests or {},
+                             'error': error})
+
+    def dump(self, path):
+        """Write the recorded events to `path`, one JSON object per line"""
+        records = list(self.records)
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        logger.info("Dumped %d events to %s" % (len(records), path))
+        return len(records)
+
+events = EventTrace()
+
+
+class Profiler(object):
+    """Profile the event loop on demand
+
+    cProfile only profiles the thread enabling it, so the profiler
+    should be started and stopped from the thread running the event
+    loop. Signal handlers are a convenient way to do so, as Python
+    always runs them in the main thread.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or '/tmp/zkfarmer-%d.prof' % os.getpid()
+        self.profile = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        if self.running:
+            return
+        logger.info("Profiling the event loop")
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling and write the statistics, readable with pstats"""
+        if not self.running:
+            return
+        profile, self.profile = self.profile, None
+        profile.disable()
+        try:
+            profile.dump_stats(self.path)
+        except (IOError, OSError) as e:
+            logger.error("Cannot write profile to %s: %s" % (self.path, e))
+            return
+        logger.info("Profile written to %s" % self.path)
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+profiler = Profiler()
@@ -1,10 +1,14 @@
-import json
 import operator
 import logging
 import re
 import time
+from collections import deque
 from socket import socket, AF_INET, SOCK_DGRAM
 
+from kazoo.exceptions import NoNodeError
+
+from .codec import COMPRESS_THRESHOLD, encode, decode
+
 logger = logging.getLogger(__name__)
 
 def ip():
@@ -20,11 +24,11 @@ def ip():
         del s
     return ip
 
-def serialize(data):
+def serialize(data, codec=None, compress_threshold=COMPRESS_THRESHOLD):
     try:
         if type(data) != dict:
             raise TypeError('Must be a dict')
-        return json.dumps(data)
+        return encode(data, codec, compress_threshold)
     except Exception, e:
         logger.warn('Cannot serialize: %s [%s]', data, e)
         return '{}'
@@ -34,7 +38,7 @@ def unserialize(serialized):
     if not serialized:
         return {}
     try:
-        data = json.loads(serialized)
+        data = decode(serialized)
         if type(data) != dict:
             raise TypeError('Not a dict')
         return data
@@ -43,6 +47,58 @@ def unserialize(serialized):
         return {}
 
 
+def _pipelined(request, paths, watch_for, max_inflight):
+    pending = deque()
+
+    def collect():
+        path, result = pending.popleft()
+        try:
+            return path, result.get()
+        except NoNodeError:
+            return path, None
+
+    for path in paths:
+        watch = watch_for and watch_for(path) or None
+        pending.append((path, request(path, watch=watch)))
+        if len(pending) >= max_inflight:
+            yield collect()
+    while pending:
+        yield collect()
+
+
+def pipelined_get(zkconn, paths, watch_for=None, max_inflight=256):
+    """Fetch several znodes using pipelined asynchronous reads
+
+    Up to `max_inflight` requests are sent to ZooKeeper before
+    waiting for the oldest one, so the total time depends on the
+    bandwidth rather than on the number of nodes times the round
+    trip. `watch_for` is an optional function returning the watcher
+    to set on a given path (or None). Yield `(path, (data, stat))`
+    tuples in the order of `paths`. A node which vanished before
+    being read is yielded as `(path, None)`.
+    """
+    return _pipelined(zkconn.get_async, paths, watch_for, max_inflight)
+
+
+def pipelined_exists(zkconn, paths, watch_for=None, max_inflight=256):
+    """Fetch the stat of several znodes using pipelined asynchronous reads
+
+    Same as `pipelined_get` but without the data of the znodes. Yield
+    `(path, stat)` tuples, `stat` being None for missing znodes. Note
+    that a watch set on a missing znode fires on its creation.
+    """
+    return _pipelined(zkconn.exists_async, paths, watch_for, max_inflight)
+
+
+def pipelined_get_children(zkconn, paths, watch_for=None, max_inflight=256):
+    """List the children of several znodes using pipelined asynchronous reads
+
+    Same as `pipelined_get` but yield `(path, children)` tuples,
+    `children` being None for missing znodes.
+    """
+    return _pipelined(zkconn.get_children_async, paths, watch_for, max_inflight)
+
+
 def dict_get_path(the_dict, path):
     try:
         return reduce(operator.getitem, [the_dict] + path.split('.'))
@@ -103,27 +159,96 @@ def match_predicates(predicates, the_dict):
     return True
 
 
-def create_filter(filters):
-    if not filters:
-        return lambda a_dict: True
+FILTER_PREDICATE = re.compile(r'^(!?)([^><!=]+)(?:(>=|<=|!=|==|=|<|>)(.*))?$')
+
+
+def parse_filter(filters):
+    """Parse a filter expression into a list of predicates
+
+    Raise ValueError if a predicate is malformed.
+    """
     predicates = []
     for f in filters.replace(' ', '').split(','):
-        predicate = {}
-        match = re.split('(!?[^><!=]+)(?:(>=|<=|!=|=|<|>)(.*))?', f, 2)
-        predicate['path'] = match[1]
-        if match[2]:
-            predicate['op'] = get_operator(match[2])
-            predicate['value'] = match[3]
+        match = FILTER_PREDICATE.match(f)
+        if not match:
+            raise ValueError('Invalid filter predicate: %r' % f)
+        negate, path, op, value = match.groups()
+        predicate = {'path': path}
+        if op:
+            if negate:
+                raise ValueError('Invalid filter predicate: %r (`!\' only applies to field existence)' % f)
+            predicate['op'] = get_operator(op)
+            predicate['value'] = value
         else:
             # predicate with not operator/value means "fields exists"
-            if predicate['path'][0] == '!':
-                predicate['path'] = predicate['path'][1:]
-                predicate['op'] = operator.is_
-            else:
-                predicate['op'] = operator.is_not
+            predicate['op'] = negate and operator.is_ or operator.is_not
             predicate['value'] = None
         predicates.append(predicate)
-    return lambda the_dict: match_predicates(predicates, the_dict)
+    return predicates
+
+
+def compile_path(path):
+    """Return a function getting the value at a dotted path of a dict, or None"""
+    keys = tuple(path.split('.'))
+    if len(keys) == 1:
+        key = keys[0]
+        def get(the_dict):
+            try:
+                return the_dict.get(key)
+            except AttributeError:
+                return None
+    else:
+        def get(the_dict):
+            try:
+                for key in keys:
+                    the_dict = the_dict[key]
+                return the_dict
+            except Exception:
+                return None
+    return get
+
+
+def compile_predicate(predicate):
+    """Compile a predicate into a function, see match_predicates()"""
+    get = compile_path(predicate['path'])
+    op, value = predicate['op'], predicate['value']
+    if value is None:
+        return lambda the_dict: op(get(the_dict), None)
+    try:
+        number = int(value)
+    except ValueError:
+        def match(the_dict):
+            current = get(the_dict)
+            return current is not None and op(current, value)
+        return match
+    def match(the_dict):
+        current = get(the_dict)
+        if current is None:
+            return False
+        try:
+            current = int(current)
+        except (ValueError, TypeError):
+            return op(current, value)
+        return op(current, number)
+    return match
+
+
+def create_filter(filters):
+    """Compile a filter expression into a function taking a node dict
+
+    Raise ValueError if the expression is malformed.
+    """
+    if not filters:
+        return lambda a_dict: True
+    predicates = [compile_predicate(p) for p in parse_filter(filters)]
+    if len(predicates) == 1:
+        return predicates[0]
+    def match(the_dict):
+        for predicate in predicates:
+            if not predicate(the_dict):
+                return False
+        return True
+    return match
 
 class ColorizingStreamHandler(logging.StreamHandler):
     """Provide a nicer logging output to error output with colors"""
@@ -9,7 +9,11 @@ import threading
 import Queue
 import time
 import itertools
+import heapq
 import os
+import json
+import hashlib
+from collections import namedtuple
 from socket import gethostname
 
 import logging as _logging
@@ -17,28 +21,231 @@ logger = _logging.getLogger(__name__)
 
 from watchdog.observers import Observer
 
-from .utils import serialize, unserialize, ip
-from kazoo.exceptions import NoNodeError, NodeExistsError, ZookeeperError
+from .utils import serialize, unserialize, ip, pipelined_get, pipelined_exists
+from .conf import ConfJSON
+from .codec import Codec
+from . import metrics, trace
+from kazoo.exceptions import NoNodeError, NodeExistsError, BadVersionError, ZookeeperError
 from kazoo.client import KazooState, OPEN_ACL_UNSAFE
 
+class CoalescingQueue(Queue.PriorityQueue):
+    """Priority queue merging identical pending events
+
+    Entries are `((priority, counter), name, args)` tuples. An event
+    which is already waiting in the queue with the same priority,
+    name and arguments is dropped: the pending one will be processed
+    against the latest state anyway. Urgent events (priority 1) are
+    never merged.
+
+    When `debounce` is set, a non urgent event is only delivered once
+    no identical event has been signaled for `debounce` seconds, but
+    never later than `max_delay` seconds (default to ten times the
+    debounce window) after it was first queued.
+    """
+
+    def __init__(self, debounce=0, max_delay=None):
+        Queue.PriorityQueue.__init__(self)
+        self.debounce = debounce
+        self.max_delay = max_delay if max_delay is not None else 10 * debounce
+        self.pending = {}       # key -> [first seen, last seen]
+        self.coalesced = 0
+        self.queued = {}        # (priority, counter) -> time queued
+        self.last_wait = None   # Time spent in the queue by the last event
+        metrics.REGISTRY.add_source(self)
+
+    def _key(self, item):
+        (priority, _), name, args = item
+        if priority <= 1:
+            return None
+        try:
+            key = (priority, name, args)
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _put(self, item):
+        key = self._key(item)
+        if key is not None:
+            now = self.debounce and time.time()
+            if key in self.pending:
+                self.pending[key][1] = now
+                self.coalesced += 1
+                if metrics.enabled:
+                    metrics.events_coalesced.inc()
+                return
+            self.pending[key] = [now, now]
+        if metrics.enabled or trace.enabled:
+            self.queued[item[0]] = time.time()
+        heapq.heappush(self.queue, item)
+
+    def _get(self):
+        item = heapq.heappop(self.queue)
+        self.pending.pop(self._key(item), None)
+        self.last_wait = None
+        if self.queued:
+            queued = self.queued.pop(item[0], None)
+            if queued is not None:
+                self.last_wait = time.time() - queued
+                if metrics.enabled:
+                    metrics.event_latency.observe(self.last_wait, priority=item[0][0])
+        return item
+
+    def collect_metrics(self):
+        with self.mutex:
+            for (priority, _), _, _ in self.queue:
+                metrics.queue_depth.inc(priority=priority)
+
+    def _due_in(self, item):
+        """Number of seconds before `item` can be delivered"""
+        if not self.debounce:
+            return 0
+        key = self._key(item)
+        if key is None:
+            return 0
+        first, last = self.pending[key]
+        return min(last + self.debounce, first + self.max_delay) - time.time()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if timeout is not None:
+                endtime = time.time() + timeout
+            while True:
+                wait = None
+                if self._qsize():
+                    wait = self._due_in(self.queue[0])
+                    if wait <= 0:
+                        item = self._get()
+                        self.not_full.notify()
+                        return item
+                if not block:
+                    raise Queue.Empty
+                if timeout is not None:
+                    remaining = endtime - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.not_empty.wait(wait)
+
+class WatchRegistry(object):
+    """Watch state of znodes, keyed by path
+
+    A path is `pending` once a watched read has been sent and `armed`
+    once ZooKeeper acknowledged it. Watches are one-shot: the path
+    should be discarded as soon as the watch fires.
+    """
+
+    PENDING = "pending"
+    ARMED = "armed"
+
+    def __init__(self):
+        self.watches = {}
+        self.pending = 0
+
+    def __contains__(self, path):
+        return path in self.watches
+
+    def __len__(self):
+        return len(self.watches)
+
+    def state(self, path):
+        return self.watches.get(path)
+
+    def register(self, path):
+        """Record a watch request, return False if already watched"""
+        if path in self.watches:
+            return False
+        self.watches[path] = self.PENDING
+        self.pending += 1
+        return True
+
+    def arm(self, path):
+        if self.watches.get(path) == self.PENDING:
+            self.pending -= 1
+        self.watches[path] = self.ARMED
+
+    def discard(self, path):
+        if self.watches.pop(path, None) == self.PENDING:
+            self.pending -= 1
+
+    def clear(self):
+        self.watches.clear()
+        self.pending = 0
+
+    def counts(self):
+        """Number of watches in each state"""
+        return {self.PENDING: self.pending,
+                self.ARMED: len(self.watches) - self.pending}
+
+class WatcherType(type):
+    """Compile the FSM of a watcher once, at class creation
+
+    `EVENTS` is turned into a `TRANSITIONS` table mapping `(event,
+    state)` to `(next state, handler)`. The handler is the
+    `exec_EVENT_from_STATE` method if it exists, the `exec_EVENT`
+    method otherwise, or None. A table with several transitions for
+    the same event and source state, or a handler not matching any
+    transition, is rejected with a ValueError.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(WatcherType, cls).__init__(name, bases, attrs)
+        cls.TRANSITIONS = cls.compile_transitions()
+
+    def compile_transitions(cls):
+        table = {}
+        handlers = set()
+        for event, transitions in cls.EVENTS.iteritems():
+            generic = "exec_%s" % event.replace(" ", "_")
+            handlers.add(generic)
+            for transition in transitions:
+                if len(transition) != 2:
+                    raise ValueError("%s: invalid transition %r for event %r" % (cls.__name__,
+                                                                               transition, event))
+                src, dst = transition
+                if (event, src) in table:
+                    raise ValueError("%s: several transitions for event %r from state %r" % (
+                            cls.__name__, event, src))
+                specific = "%s_from_%s" % (generic, src.replace(" ", "_"))
+                handlers.add(specific)
+                execute = getattr(cls, specific, None) or getattr(cls, generic, None)
+                table[(event, src)] = (dst, execute and execute.__func__)
+        unknown = [name for name in dir(cls)
+                   if name.startswith("exec_") and name not in handlers]
+        if unknown:
+            raise ValueError("%s: no transition for handlers %s" % (cls.__name__,
+                                                                    ", ".join(sorted(unknown))))
+        return table
+
 class ZkFarmWatcher(object):
 
+    __metaclass__ = WatcherType
+
     # Each subclass should implement a FSM. EVENTS is a
     # dictionary. Each event is associated to a list of transition. A
     # transition is a dictionary with a tuple `(src, dst)`
     # (states). Initial event is always "initial". When a function
-    # "execute_NAME", with NAME being the event, exists, it will be
-    # executed.
+    # "exec_NAME_from_STATE" or "exec_NAME", with NAME being the
+    # event and STATE the source state, exists, it will be
+    # executed. The table is compiled into TRANSITIONS when the class
+    # is created (see WatcherType).
     EVENTS = {}
 
-    def __init__(self, zkconn):
-        self.events = Queue.PriorityQueue()
-        self.counter = itertools.count()
+    def __init__(self, zkconn, debounce=0, max_delay=None, group=None):
+        self.group = group
+        if group is None:
+            self.events = CoalescingQueue(debounce, max_delay)
+            self.counter = itertools.count()
+        else:
+            self.events = group.register(self)
+            self.counter = group.counter
+        self.errors = 0
         self.zkconn = zkconn
         self.zkconn.add_listener(self._zkchange)
         self.state = "initial"
 
     def _zkchange(self, state):
+        metrics.connection_changes.inc(state=str(state).lower())
         if state == KazooState.CONNECTED:
             logger.info("Now connected to Zookeeper")
             self.urgent_event("connection recovered")
@@ -50,6 +257,13 @@ class ZkFarmWatcher(object):
             logger.debug("Connection is considered as lost")
             self.urgent_event("connection lost")
 
+    def stop(self):
+        """Stop following the connection state and reporting metrics"""
+        self.zkconn.remove_listener(self._zkchange)
+        metrics.REGISTRY.remove_source(self)
+        if self.group is None:
+            metrics.REGISTRY.remove_source(self.events)
+
     def event(self, name, *args):
         """Signal a new event to the main thread"""
         self.events.put(((2, next(self.counter)), name, args))
@@ -58,7 +272,6 @@ class ZkFarmWatcher(object):
         self.events.put(((1, next(self.counter)), name, args))
 
     def loop(self, count=None, timeout=10, ignore_unknown_transitions=False):
-        errors = 0
         while count is None or count > 0:
             if count is not None:
                 count -= 1
@@ -68,44 +281,126 @@ class ZkFarmWatcher(object):
                 priority, event, args = self.events.get(True, timeout=timeout)
             except Queue.Empty:
                 continue
+            self.process(priority, event, args, ignore_unknown_transitions, self.events.last_wait)
 
-            transition = [t for t in self.EVENTS[event] if t[0] == self.state]
-            if not transition:
-                text = "unknown transition for event %r from state %r" % (event,
-                                                                          self.state)
-                logger.warn(text)
-                if not ignore_unknown_transitions:
-                    raise RuntimeError(text)
-                continue
-            transition = transition[0]
-            logger.debug("Transition from %r to %r next to event %r" % (transition[0],
-                                                                        transition[1],
-                                                                         event))
-            execute = None
-            do = True
-            execute = getattr(self, "exec_%s_from_%s" % (event.replace(" ", "_"),
-                                                         transition[0].replace(" ", "_")),
-                              None)
-            if execute is None:
-                execute = getattr(self, "exec_%s" % event.replace(" ", "_"),
-                                  None)
+    def process(self, priority, event, args, ignore_unknown_transitions=False, wait=None):
+        """Execute the transition triggered by an event
+
+        `wait` is the time the event spent in the queue, if known.
+        """
+        try:
+            state, execute = self.TRANSITIONS[event, self.state]
+        except KeyError:
+            text = "unknown transition for event %r from state %r" % (event,
+                                                                      self.state)
+            logger.warn(text)
+            if not ignore_unknown_transitions:
+                raise RuntimeError(text)
+            return
+        logger.debug("Transition from %r to %r next to event %r",
+                     self.state, state, event)
+        if not (metrics.enabled or trace.enabled):
+            if self._execute(priority, event, args, execute)[0]:
+                self.state = state
+            return
+
+        name = self.__class__.__name__
+        requests = trace.enabled and getattr(self.zkconn, 'requests', None)
+        before = requests and dict(requests)
+        start = time.time()
+        do, error = self._execute(priority, event, args, execute)
+        duration = time.time() - start
+        if metrics.enabled:
+            metrics.events.inc(watcher=name, event=event)
             if execute is not None:
-                try:
-                    logger.debug("And execute the appropriate action %r" % execute)
-                    if execute(*args) is False:
-                        do = False
-                    errors = 0
-                except ZookeeperError, e:
-                    logger.exception("Got a zookeeper exception, reschedule the transition")
-                    self.events.put((priority, event, args))
-                    do = False
-                    errors += 1
-                    if errors > 10:
-                        logger.warn("Too many errors, wait a bit")
-                        time.sleep(2)
-                        errors = 7
-            if do:
-                self.state = transition[1]
+                metrics.transition_duration.observe(duration, watcher=name, event=event)
+        if trace.enabled:
+            if requests is not None:
+                requests = dict((op, count - before.get(op, 0)) for op, count in requests.items()
+                                if count != before.get(op, 0))
+            trace.events.record(name, event, self.state, do and state or self.state, wait,
+                                duration, requests, error)
+        if do:
+            self.state = state
+
+    def _execute(self, priority, event, args, execute):
+        """Execute the action of a transition
+
+        Return whether the transition should happen and the ZooKeeper
+        error which prevented it, if any.
+        """
+        if execute is None:
+            return True, None
+        try:
+            logger.debug("And execute the appropriate action %r", execute.__name__)
+            do = execute(self, *args) is not False
+            self.errors = 0
+            return do, None
+        except ZookeeperError, e:
+            logger.exception("Got a zookeeper exception, reschedule the transition")
+            self.events.put((priority, event, args))
+            self.errors += 1
+            if self.errors > 10:
+                logger.warn("Too many errors, wait a bit")
+                time.sleep(2)
+                self.errors = 7
+            return False, repr(e)
+
+    def _write_conf(self, obj):
+        """Write `obj` to the local configuration, recording time and size"""
+        if not metrics.enabled:
+            self.conf.write(obj)
+            return
+        name = self.conf.__class__.__name__
+        written = getattr(self.conf, 'bytes_written', 0)
+        with metrics.conf_write_duration.time(conf=name):
+            self.conf.write(obj)
+        metrics.conf_written_bytes.inc(getattr(self.conf, 'bytes_written', 0) - written, conf=name)
+
+class WatcherGroup(object):
+    """Several watchers sharing a single event queue and loop
+
+    Watchers are attached to the group by passing it as their `group`
+    argument. Their events are tagged with the watcher so they can be
+    dispatched from a single thread while keeping the arrival order
+    across all of them.
+    """
+
+    def __init__(self, debounce=0, max_delay=None):
+        self.events = CoalescingQueue(debounce, max_delay)
+        self.counter = itertools.count()
+        self.watchers = []
+
+    def register(self, watcher):
+        """Attach a watcher, return the queue it should post events to"""
+        self.watchers.append(watcher)
+        return GroupEvents(self.events, watcher)
+
+    def loop(self, count=None, timeout=10, ignore_unknown_transitions=False):
+        while count is None or count > 0:
+            if count is not None:
+                count -= 1
+
+            try:
+                priority, (watcher, event), args = self.events.get(True, timeout=timeout)
+            except Queue.Empty:
+                continue
+            watcher.process(priority, event, args, ignore_unknown_transitions, self.events.last_wait)
+
+class GroupEvents(object):
+    """Queue proxy tagging the events of a watcher belonging to a group"""
+
+    def __init__(self, events, watcher):
+        self.events = events
+        self.watcher = watcher
+
+    def put(self, item):
+        priority, name, args = item
+        self.events.put((priority, (self.watcher, name), args))
+
+# Stat of a node loaded from a snapshot
+SnapshotStat = namedtuple('SnapshotStat', ['version', 'mzxid'])
+
 
 class ZkFarmExporter(ZkFarmWatcher):
 
@@ -124,26 +419,103 @@ class ZkFarmExporter(ZkFarmWatcher):
                                           ("lost",      "lost")],
                "connection recovered":   [("lost",      "initial"),
                                           ("idle",      "initial"),
-                                          ("initial",   "initial")] }
-
-    def __init__(self, zkconn, root_node_path, conf, updated_handler=None, filter_handler=None):
-        super(ZkFarmExporter, self).__init__(zkconn)
+                                          ("initial",   "initial")],
+               "save snapshot":          [("initial",   "initial"),
+                                          ("idle",      "idle"),
+                                          ("lost",      "lost")] }
+
+    def __init__(self, zkconn, root_node_path, conf, updated_handler=None, filter_handler=None,
+                 max_inflight=256, debounce=0, max_delay=None, group=None, snapshot=None,
+                 snapshot_interval=10):
+        super(ZkFarmExporter, self).__init__(zkconn, debounce, max_delay, group)
         self.root_node_path = root_node_path
         self.conf = conf
         self.updated_handler = updated_handler
         self.filter_handler = filter_handler
+        self.max_inflight = max_inflight
+        self.snapshot = snapshot and ConfJSON(snapshot)
+        # The snapshot is saved at most once every `snapshot_interval`
+        # seconds, a timer posting "save snapshot" when it is behind
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_saved = 0
+        self.snapshot_dirty = False
+        self.snapshot_timer = None
+        self.nodes = self._load_snapshot()  # name -> (info, stat) of each known child
+        metrics.REGISTRY.add_source(self)
 
         self.event("initial setup")
 
+    def _load_snapshot(self):
+        """Return the nodes saved in the snapshot, if any"""
+        if not self.snapshot:
+            return {}
+        try:
+            snapshot = self.snapshot.read()
+            if snapshot is None:
+                return {}
+            if snapshot.get('root') != self.root_node_path:
+                raise ValueError('snapshot of another farm (%s)' % snapshot.get('root'))
+            nodes = dict((name, (node['info'], SnapshotStat(node['version'], node['mzxid'])))
+                         for name, node in snapshot['nodes'].iteritems())
+        except Exception as e:
+            logger.warn("Ignoring snapshot %s: %s" % (self.snapshot.file_path, e))
+            return {}
+        logger.info("Loaded %d nodes from snapshot %s" % (len(nodes), self.snapshot.file_path))
+        return nodes
+
+    def _save_snapshot(self):
+        """Save the known nodes with their version to the snapshot"""
+        nodes = dict((name, {'info': info, 'version': stat.version, 'mzxid': stat.mzxid})
+                     for name, (info, stat) in self.nodes.iteritems())
+        try:
+            self.snapshot.write({'root': self.root_node_path, 'nodes': nodes})
+        except Exception as e:
+            logger.warn("Cannot save snapshot %s: %s" % (self.snapshot.file_path, e))
+        self.snapshot_saved = time.time()
+        self.snapshot_dirty = False
+
+    def _schedule_snapshot(self):
+        """Save the snapshot now, or once the interval since the last save elapsed"""
+        self.snapshot_dirty = True
+        if self.snapshot_timer is not None:
+            return              # Already scheduled
+        delay = self.snapshot_saved + self.snapshot_interval - time.time()
+        if delay <= 0:
+            self._save_snapshot()
+            return
+        self.snapshot_timer = threading.Timer(delay, self.event, ("save snapshot",))
+        self.snapshot_timer.daemon = True
+        self.snapshot_timer.start()
+
+    def exec_save_snapshot(self):
+        self.snapshot_timer = None
+        if self.snapshot_dirty:
+            self._save_snapshot()
+
+    def stop(self):
+        """Stop watching and save the snapshot if it is behind"""
+        super(ZkFarmExporter, self).stop()
+        if self.snapshot_timer is not None:
+            self.snapshot_timer.cancel()
+            self.snapshot_timer = None
+        if self.snapshot_dirty:
+            self._save_snapshot()
+
+    def collect_metrics(self):
+        # Several exporters may follow the same farm
+        metrics.farm_nodes.inc(len(self.nodes), farm=self.root_node_path)
+        if hasattr(self, 'monitored'):
+            for state, count in self.monitored.counts().iteritems():
+                metrics.watches.inc(count, state=state)
+
     def watch_children(self, _):
         self.event("children modified")
     def watch_node(self, what):
         self.event("node modified", what)
 
     def get_watcher_node(self, path):
-        if path in self.monitored:
+        if not self.monitored.register(path):
             return None         # Already monitored
-        self.monitored.append(path)
         return self.watch_node
 
     def exec_connection_recovered(self):
@@ -153,38 +525,188 @@ class ZkFarmExporter(ZkFarmWatcher):
 
     def exec_initial_setup(self):
         """Watch for new children"""
-        self.monitored = []
+        self.monitored = WatchRegistry()
         self.root_monitored = False
-        try:
-            self.zkconn.ensure_path(self.root_node_path, acl=OPEN_ACL_UNSAFE)
-        except NodeExistsError:
-            pass
+        # Nodes known from the snapshot or a previous session are kept
+        # until their stat is checked against ZooKeeper
+        self.unverified = set(self.nodes)
+        self.synced = False
+        self._ensure_root()
         self.event("children modified")
     def exec_initial_setup_from_idle(self):
         # This may happen because we recovered the connection several times
         pass
 
-    def exec_children_modified(self):
-        self.root_monitored = False
-    def exec_children_modified_from_idle(self):
-        """A change has occurred on a child"""
+    def _ensure_root(self):
+        try:
+            self.zkconn.ensure_path(self.root_node_path, acl=OPEN_ACL_UNSAFE)
+        except NodeExistsError:
+            pass
+
+    def _export(self):
+        """Write the current state of the farm to the configuration"""
         new_conf = {}
-        nodes = self.zkconn.get_children(self.root_node_path,
-                                         watch=(self.root_monitored and None or self.watch_children))
-        for name in nodes:
-            subnode_path = '%s/%s' % (self.root_node_path, name)
-            info = unserialize(self.zkconn.get(subnode_path,
-                                               watch=self.get_watcher_node(subnode_path))[0])
+        for name, (info, stat) in self.nodes.iteritems():
             if not self.filter_handler or self.filter_handler(info):
                 new_conf[name] = info
-        self.conf.write(new_conf)
+        self._write_conf(new_conf)
+        if self.snapshot:
+            self._schedule_snapshot()
         if self.updated_handler:
             self.updated_handler()
 
+    def exec_children_modified(self):
+        self.root_monitored = False
+    def exec_children_modified_from_idle(self):
+        """A child has been added or removed"""
+        names = set(self.zkconn.get_children(self.root_node_path,
+                                             watch=(self.root_monitored and None or self.watch_children)))
+        removed = [name for name in self.nodes if name not in names]
+        for name in removed:
+            del self.nodes[name]
+            self.unverified.discard(name)
+        paths = ['%s/%s' % (self.root_node_path, name)
+                 for name in names if name not in self.nodes]
+        # Only fetch the stat of the nodes already known, and then the
+        # data of those which changed
+        verify = ['%s/%s' % (self.root_node_path, name)
+                  for name in names if name in self.unverified]
+        for subnode_path, stat in pipelined_exists(self.zkconn, verify,
+                                                   watch_for=self.get_watcher_node,
+                                                   max_inflight=self.max_inflight):
+            name = subnode_path.rsplit('/', 1)[1]
+            self.unverified.discard(name)
+            if stat is None:
+                # The node vanished
+                self.monitored.discard(subnode_path)
+                del self.nodes[name]
+                removed.append(name)
+                continue
+            if subnode_path in self.monitored:
+                self.monitored.arm(subnode_path)
+            info, known = self.nodes[name]
+            if (stat.mzxid, stat.version) == (known.mzxid, known.version):
+                self.nodes[name] = (info, stat)
+            else:
+                paths.append(subnode_path)
+        for subnode_path, result in pipelined_get(self.zkconn, paths,
+                                                  watch_for=self.get_watcher_node,
+                                                  max_inflight=self.max_inflight):
+            name = subnode_path.rsplit('/', 1)[1]
+            if result is None:
+                # The node vanished, no watch has been set on it
+                self.monitored.discard(subnode_path)
+                if self.nodes.pop(name, None) is not None:
+                    removed.append(name)
+                continue
+            if subnode_path in self.monitored:
+                self.monitored.arm(subnode_path)
+            self.nodes[name] = (unserialize(result[0]), result[1])
+        if removed or paths or not self.synced:
+            self.synced = True
+            if logger.isEnabledFor(_logging.DEBUG):
+                logger.debug("Exporting %d nodes, watches: %r", len(self.nodes),
+                             self.monitored.counts())
+            self._export()
+
     def exec_node_modified(self, what):
         """A change has occurred inside the node"""
-        self.monitored.remove(what.path)
-        self.event("children modified")
+        self.monitored.discard(what.path)
+    def exec_node_modified_from_idle(self, what):
+        """A change has occurred inside the node, only refetch this one"""
+        if what.path is None:
+            return              # Watches dropped with the session
+        self.monitored.discard(what.path)
+        name = what.path.rsplit('/', 1)[1]
+        if name not in self.nodes:
+            return              # Not exported (yet), children watch will handle it
+        try:
+            data, stat = self.zkconn.get(what.path, watch=self.get_watcher_node(what.path))
+        except NoNodeError:
+            self.monitored.discard(what.path)
+            del self.nodes[name]
+            self._export()
+            return
+        self.monitored.arm(what.path)
+        if stat.mzxid == self.nodes[name][1].mzxid:
+            return
+        self.nodes[name] = (unserialize(data), stat)
+        self._export()
+
+class ZkFarmChecker(ZkFarmExporter):
+    """Watch a farm and report its status each time it changes
+
+    Nodes are tracked like the exporter does, along with the farm
+    properties. Instead of writing a configuration, the farm is
+    evaluated with `check_handler(zknode, props, nodes)`, `nodes`
+    mapping the name of each node to its info, and
+    `result_handler(zknode, status, reason)` is called when the
+    returned status differs from the previous one.
+    """
+
+    EVENTS = dict(ZkFarmExporter.EVENTS,
+                  **{"farm modified":    [("idle",      "idle"),
+                                          ("lost",      "lost")]})
+
+    def __init__(self, zkconn, root_node_path, check_handler, result_handler,
+                 max_inflight=256, debounce=0, max_delay=None, group=None):
+        self.check_handler = check_handler
+        self.result_handler = result_handler
+        self.props = None       # Farm properties, once fetched
+        self.status = None      # Last reported status
+        super(ZkFarmChecker, self).__init__(zkconn, root_node_path, None,
+                                            max_inflight=max_inflight, debounce=debounce,
+                                            max_delay=max_delay, group=group)
+
+    def watch_farm(self, _):
+        self.event("farm modified")
+
+    def exec_initial_setup(self):
+        """Watch for the farm properties and its children"""
+        super(ZkFarmChecker, self).exec_initial_setup()
+        self.event("farm modified")
+
+    def _ensure_root(self):
+        # Checking a farm should not create it
+        pass
+
+    def _export(self):
+        """Evaluate the farm and report its status if it changed"""
+        if self.props is None:
+            return
+        status, reason = self.check_handler(self.root_node_path, self.props,
+                                            dict((name, info) for name, (info, _) in self.nodes.iteritems()))
+        if status != self.status:
+            logger.info("Farm %s status changed from %r to %r" % (self.root_node_path,
+                                                                  self.status, status))
+            self.status = status
+            self.result_handler(self.root_node_path, status, reason)
+
+    def exec_children_modified_from_idle(self):
+        try:
+            super(ZkFarmChecker, self).exec_children_modified_from_idle()
+        except NoNodeError:
+            # Wait for the farm to be created
+            if self.zkconn.exists(self.root_node_path, watch=self.watch_children):
+                self.event("children modified")
+                return
+            self.nodes.clear()
+            self.unverified.clear()
+            self._export()
+
+    def exec_farm_modified_from_idle(self):
+        """The farm properties have been modified"""
+        try:
+            props = unserialize(self.zkconn.get(self.root_node_path, watch=self.watch_farm)[0])
+        except NoNodeError:
+            # Wait for the farm to be created
+            if self.zkconn.exists(self.root_node_path, watch=self.watch_farm):
+                self.event("farm modified")
+                return
+            props = {'size': 0}
+        if props != self.props:
+            self.props = props
+            self._export()
 
 class ZkFarmImporter(ZkFarmWatcher):
 
@@ -207,15 +729,28 @@ class ZkFarmImporter(ZkFarmWatcher):
                "connection recovered":   [("lost",      "observer ready"),
                                           ("observer ready", "observer ready")]}
 
-    def __init__(self, zkconn, root_node_path, conf, common=False):
-        super(ZkFarmImporter, self).__init__(zkconn)
+    def __init__(self, zkconn, root_node_path, conf, common=False, debounce=0, max_delay=None):
+        super(ZkFarmImporter, self).__init__(zkconn, debounce, max_delay)
         self.conf = conf
         self.common = common
+        self.root_node_path = root_node_path
         self.node_path = "%s/%s" % (root_node_path,
                                     common and "common" or ip())
+        self.codec = None
+        # Paths under which a change is a change of the configuration
+        self.conf_paths = set([os.path.abspath(conf.file_path),
+                               os.path.realpath(conf.file_path)])
+        # Digest of the local configuration known to be in ZooKeeper
+        self.synced = None
+        # Last known content and version of the znode
+        self.remote = None
 
         self.event("initial setup")
 
+    @staticmethod
+    def _digest(conf):
+        return hashlib.sha1(json.dumps(conf, sort_keys=True, default=repr)).hexdigest()
+
     def _safe_local_conf(self):
         """Return the current local configuration or {} on errors"""
         try:
@@ -231,23 +766,43 @@ class ZkFarmImporter(ZkFarmWatcher):
 
     def exec_initial_setup(self):
         """Non-zookeeper related initial setup"""
-        # Setup observer
+        # Setup observer. A file cannot be watched by itself, only its
+        # directory, but there is no need to watch the subdirectories.
         observer = Observer()
         path = self.conf.file_path
-        if not os.path.isdir(path):
-            path = os.path.dirname(os.path.realpath(path))
-        observer.schedule(self, path=path, recursive=True)
+        if os.path.isdir(path):
+            observer.schedule(self, path=path, recursive=True)
+        else:
+            observer.schedule(self, path=os.path.dirname(os.path.realpath(path)), recursive=False)
         observer.start()
 
         self.mzxid = None
         self.event("initial znode setup")
 
+    def _farm_codec(self):
+        """Return the codec recorded in the farm znode"""
+        try:
+            name = unserialize(self.zkconn.get(self.root_node_path)[0]).get('codec')
+            Codec(name)
+        except NoNodeError:
+            return None
+        except (ValueError, RuntimeError) as e:
+            logger.warn("Using JSON to encode the node: %s" % e)
+            return None
+        return name
+
     def exec_initial_znode_setup(self):
         """Initial setup of znode"""
+        self.synced = None
+        self.remote = None
         try:
             self.zkconn.ensure_path(os.path.dirname(self.node_path))
-            self.zkconn.create(self.node_path, serialize(self._safe_local_conf()),
+            self.codec = self._farm_codec()
+            local_conf = self._safe_local_conf()
+            self.zkconn.create(self.node_path, serialize(local_conf, self.codec),
                                acl=OPEN_ACL_UNSAFE, ephemeral=(not self.common))
+            self.synced = self._digest(local_conf)
+            self.remote = (local_conf, 0)
         except NodeExistsError:
             # Already exists.
             if self.common:
@@ -267,33 +822,62 @@ class ZkFarmImporter(ZkFarmWatcher):
         pass
     def exec_local_modified_from_idle(self):
         """Check a local modification"""
-        current_conf = unserialize(self.zkconn.get(self.node_path)[0])
         try:
             new_conf = self.conf.read()
         except Exception as e:
             logger.warn("Ignoring invalid local configuration: %s" % e)
             return
-        if current_conf != new_conf:
+        digest = self._digest(new_conf)
+        if digest == self.synced:
+            logger.debug('Local conf unchanged')
+            return
+        if self.remote is None:
+            self._fetch_remote()
+        while self.remote[0] != new_conf:
+            current_conf, version = self.remote
             logger.info('Local conf changed')
             logger.debug('Previous conf:   %r' % current_conf)
             logger.debug('New conf:        %r' % new_conf)
-            s = self.zkconn.set(self.node_path, serialize(new_conf))
+            try:
+                s = self.zkconn.set(self.node_path, serialize(new_conf, self.codec), version=version)
+            except BadVersionError:
+                logger.info('Znode modified in the meantime, checking it again')
+                self._fetch_remote()
+                continue
             self.mzxid = s.mzxid # Record latest mzxid
+            self.remote = (new_conf, s.version)
+        self.synced = digest
+
+    def _fetch_remote(self, watch=None):
+        """Fetch the znode, record and return its content and stat"""
+        data, stat = self.zkconn.get(self.node_path, watch=watch)
+        self.remote = (unserialize(data), stat.version)
+        return self.remote[0], stat
+
+    def _is_conf(self, path):
+        return any(path == conf_path or path.startswith(conf_path + os.sep)
+                   for conf_path in self.conf_paths)
 
     def dispatch(self, event):
         """A local change has occured"""
-        if hasattr(event, "src_path") and event.src_path.startswith(self.conf.file_path) \
-           or hasattr(event, "dst_path") and event.dst_path.startswith(self.conf.file_path) \
-           or hasattr(event, "dest_path") and event.dest_path.startswith(self.conf.file_path):
-            self.event("local modified")
+        for attr in ("src_path", "dst_path", "dest_path"):
+            path = getattr(event, attr, None)
+            if path and self._is_conf(path):
+                self.event("local modified")
+                return
 
 class ZkFarmJoiner(ZkFarmImporter):
 
     def __init__(self, zkconn, root_node_path, conf, common=False,
-                 updated_handler=None):
+                 updated_handler=None, debounce=0, max_delay=None):
         self.updated_handler = updated_handler
         super(ZkFarmJoiner, self).__init__(zkconn, root_node_path,
-                                           conf, common)
+                                           conf, common, debounce, max_delay)
+        metrics.REGISTRY.add_source(self)
+
+    def collect_metrics(self):
+        if getattr(self, 'monitored', False):
+            metrics.watches.inc(state=WatchRegistry.ARMED)
 
     def watch_node(self, what):
         self.event("znode modified")
@@ -304,7 +888,7 @@ class ZkFarmJoiner(ZkFarmImporter):
         info = self._safe_local_conf()
         if not self.common:
             info['hostname'] = gethostname()
-        self.conf.write(info)
+        self._write_conf(info)
         if self.updated_handler:
             self.updated_handler()
 
@@ -313,7 +897,7 @@ class ZkFarmJoiner(ZkFarmImporter):
     def exec_initial_znode_setup(self):
         super(ZkFarmJoiner, self).exec_initial_znode_setup()
         # Setup the watcher
-        self.zkconn.get(self.node_path, self.watch_node)
+        self._fetch_remote(watch=self.watch_node)
         self.monitored = True
 
     def exec_znode_modified(self):
@@ -327,19 +911,19 @@ class ZkFarmJoiner(ZkFarmImporter):
             logger.warn("Ignoring incorrect local configuration: %s" % e)
             current_conf = {}
         try:
-            new = self.zkconn.get(self.node_path,
-                                  watch=(self.monitored and None or self.watch_node))
-            if new[1].mzxid <= self.mzxid:
+            new_conf, stat = self._fetch_remote(watch=(self.monitored and None or self.watch_node))
+            if stat.mzxid <= self.mzxid:
                 logger.debug('Discard remote modification older than '
-                             'latest local modification (%r <= %r)' % (new[1].mzxid, self.mzxid))
+                             'latest local modification (%r <= %r)' % (stat.mzxid, self.mzxid))
                 return
-            new_conf = unserialize(new[0])
             if current_conf != new_conf:
                 logger.info('Remote conf changed')
                 logger.debug('Previous conf: %r' % current_conf)
                 logger.debug('New conf:      %r' % new_conf)
-                self.conf.write(new_conf)
+                self._write_conf(new_conf)
                 if self.updated_handler:
                     self.updated_handler()
+            # Our own write will be noticed by the observer
+            self.synced = self._digest(new_conf)
         except NoNodeError:
             logger.warn("not able to watch for node %s: not exist anymore" % self.node_path)
@@ -5,8 +5,14 @@
 # For the full copyright and license information, please view the LICENSE
 # file that was distributed with this source code.
 
-from .utils import serialize, unserialize, dict_set_path, dict_filter, create_filter
-from .watcher import ZkFarmJoiner, ZkFarmExporter, ZkFarmImporter
+import os
+import urllib
+
+from .utils import serialize, unserialize, dict_set_path, dict_filter, create_filter, pipelined_get, \
+    pipelined_get_children
+from .watcher import ZkFarmJoiner, ZkFarmExporter, ZkFarmImporter, ZkFarmChecker, WatcherGroup
+from .table import FarmTable
+from .codec import detect
 
 from kazoo.client import OPEN_ACL_UNSAFE
 from kazoo.exceptions import NoNodeError, BadVersionError
@@ -16,11 +22,13 @@ class ZkFarmer(object):
     STATUS_WARNING = 1
     STATUS_CRITICAL = 2
     STATUS_UNKNOWN = 3
+    # From the least to the most severe
+    STATUS_SEVERITY = [STATUS_OK, STATUS_UNKNOWN, STATUS_WARNING, STATUS_CRITICAL]
 
     def __init__(self, zkconn):
         self.zkconn = zkconn
 
-    def join(self, zknode, conf, common=False, updated_handler=None):
+    def join(self, zknode, conf, common=False, updated_handler=None, debounce=0, max_delay=None):
         # Create farms ZkNode if doesn't already exists
         self.zkconn.retry(self.zkconn.ensure_path, zknode, acl=OPEN_ACL_UNSAFE)
         # If we are going to enlarged the farm max seen size, store it
@@ -29,16 +37,48 @@ class ZkFarmer(object):
             if current_size > self.get(zknode, 'size'):
                 self.set(zknode, 'size', current_size)
         # Join the farm
-        ZkFarmJoiner(self.zkconn, zknode, conf, common,
-                     updated_handler).loop(ignore_unknown_transitions=True)
+        ZkFarmJoiner(self.zkconn, zknode, conf, common, updated_handler,
+                     debounce, max_delay).loop(ignore_unknown_transitions=True)
+
+    def importer(self, zknode, conf, common=False, debounce=0, max_delay=None):
+        ZkFarmImporter(self.zkconn, zknode, conf, common,
+                       debounce, max_delay).loop(ignore_unknown_transitions=True)
 
-    def importer(self, zknode, conf, common=False):
-        ZkFarmImporter(self.zkconn, zknode, conf, common).loop(ignore_unknown_transitions=True)
+    def export(self, zknode, conf, updated_handler=None, filters=None, max_inflight=256,
+               debounce=0, max_delay=None, snapshot_dir=None):
+        self.export_farms([(zknode, conf)], updated_handler, filters, max_inflight,
+                          debounce, max_delay, snapshot_dir)
 
-    def export(self, zknode, conf, updated_handler=None, filters=None):
-        ZkFarmExporter(self.zkconn, zknode, conf,
-                       updated_handler,
-                       filter_handler=create_filter(filters)).loop(ignore_unknown_transitions=True)
+    def export_farms(self, farms, updated_handler=None, filters=None, max_inflight=256,
+                     debounce=0, max_delay=None, snapshot_dir=None):
+        """Export several farms
+
+        `farms` is a list of `(zknode, conf)` pairs, optionally
+        followed by a dictionary overriding the `updated_handler` and
+        `filters` arguments for this farm. All farms are exported using
+        the same ZooKeeper session and event loop. When `snapshot_dir`
+        is given, the state of each farm is saved there so that a
+        restarted exporter only fetches the nodes modified in the
+        meantime.
+        """
+        group = WatcherGroup(debounce, max_delay)
+        for farm in farms:
+            options = farm[2] if len(farm) > 2 else {}
+            snapshot = None
+            if snapshot_dir is not None:
+                snapshot = os.path.join(snapshot_dir, '%s.json' % urllib.quote(farm[0], safe=''))
+            ZkFarmExporter(self.zkconn, farm[0], farm[1],
+                           options.get('updated_handler', updated_handler),
+                           filter_handler=create_filter(options.get('filters', filters)),
+                           max_inflight=max_inflight,
+                           group=group,
+                           snapshot=snapshot)
+        try:
+            group.loop(ignore_unknown_transitions=True)
+        finally:
+            # Save the snapshots left behind by the last changes
+            for watcher in group.watchers:
+                watcher.stop()
 
     def list(self, zknode):
         try:
@@ -53,11 +93,45 @@ class ZkFarmer(object):
             return {'size': 0}
         return dict_filter(unserialize(data), field_or_fields)
 
+    def nodes(self, zknode, filters=None, max_inflight=256):
+        """Iterate over the `(name, info)` pairs of the children of `zknode`
+
+        Children are fetched using pipelined reads and yielded as they
+        arrive, in the order of `list()`. Only the children matching
+        `filters` are yielded.
+        """
+        filter_handler = create_filter(filters)
+        paths = ['%s/%s' % (zknode.rstrip('/'), name) for name in self.list(zknode)]
+        for path, result in pipelined_get(self.zkconn, paths, max_inflight=max_inflight):
+            if result is None:
+                continue        # Removed since listed
+            info = unserialize(result[0])
+            if filter_handler(info):
+                yield path.rsplit('/', 1)[1], info
+
+    def table(self, zknode, max_inflight=256):
+        """Load the nodes of a farm into a FarmTable"""
+        nodes = {}
+        paths = ['%s/%s' % (zknode.rstrip('/'), name)
+                 for name in self.list(zknode) if str(name) != "common"]
+        for path, result in pipelined_get(self.zkconn, paths, max_inflight=max_inflight):
+            if result is not None:
+                nodes[path.rsplit('/', 1)[1]] = unserialize(result[0])
+        return FarmTable(nodes)
+
+    def stats(self, zknode, filters=None, fields=None, percentiles=(50, 90, 99)):
+        table = self.table(zknode)
+        mask = table.mask(filters)
+        return {'nodes': int(mask.sum()),
+                'fields': table.stats(fields, percentiles, mask)}
+
     def _save_safe(self, zknode, info, data):
+        # Keep the encoding of the current payload
+        codec = detect(data[0]).name
         retry = 3
         while retry:
             try:
-                self.zkconn.retry(self.zkconn.set, zknode, serialize(info), data[1].version)
+                self.zkconn.retry(self.zkconn.set, zknode, serialize(info, codec), data[1].version)
                 break
             except BadVersionError:
                 # remove value changed since I get it, retry with fresh value
@@ -77,13 +151,94 @@ class ZkFarmer(object):
             del info[field]
         self._save_safe(zknode, info, data)
 
-    def check(self, zknode, max_failed_node, warn_failed_node=None):
-        props = self.get(zknode)
+    def farms(self, zknode, max_inflight=256):
+        """Find the farms under `zknode`, including itself
+
+        Farms are the znodes having a `size' property. Their children
+        are not explored.
+        """
+        farms = []
+        level = [zknode]
+        while level:
+            others = []
+            for path, result in pipelined_get(self.zkconn, level, max_inflight=max_inflight):
+                if result is None:
+                    continue
+                if 'size' in unserialize(result[0]):
+                    farms.append(path)
+                else:
+                    others.append(path)
+            level = []
+            for path, children in pipelined_get_children(self.zkconn, others, max_inflight=max_inflight):
+                level.extend('%s/%s' % (path.rstrip('/'), name) for name in children or [])
+        return sorted(farms)
+
+    def worst_status(self, statuses):
+        """Return the most severe of `statuses`"""
+        return max(statuses or [self.STATUS_OK], key=self.STATUS_SEVERITY.index)
 
+    def check(self, zknode, max_failed_node, warn_failed_node=None, max_inflight=256):
+        return self.check_farms([zknode], max_failed_node, warn_failed_node, max_inflight)[0][1]
+
+    def check_farms(self, zknodes, max_failed_node, warn_failed_node=None, max_inflight=256):
+        """Check the health of several farms at once
+
+        The farm properties, their children and the nodes needed to
+        evaluate their `running_filter' are fetched using pipelined
+        reads shared by all the farms. Return a list of
+        `(zknode, (status, reason))` in the order of `zknodes`.
+        """
+        props = {}
+        for zknode, result in pipelined_get(self.zkconn, zknodes, max_inflight=max_inflight):
+            props[zknode] = unserialize(result[0]) if result is not None else {'size': 0}
+        children = {}
+        for zknode, names in pipelined_get_children(self.zkconn, zknodes, max_inflight=max_inflight):
+            children[zknode] = names or []
+
+        nodes = {}              # farm -> {name: info}, info is only fetched when filtered
+        owners = {}             # node path -> (farm, name)
+        for zknode in zknodes:
+            nodes[zknode] = dict((name, None) for name in children[zknode])
+            if 'running_filter' not in props[zknode]:
+                continue
+            try:
+                create_filter(props[zknode]['running_filter'])
+            except ValueError:
+                continue
+            nodes[zknode] = {}
+            for name in children[zknode]:
+                owners['%s/%s' % (zknode.rstrip('/'), name)] = (zknode, name)
+        for path, result in pipelined_get(self.zkconn, sorted(owners), max_inflight=max_inflight):
+            if result is not None:
+                zknode, name = owners[path]
+                nodes[zknode][name] = unserialize(result[0])
+
+        return [(farm, self._evaluate(farm, props[farm], nodes[farm],
+                                      max_failed_node, warn_failed_node))
+                for farm in zknodes]
+
+    def check_daemon(self, zknodes, max_failed_node, warn_failed_node=None, result_handler=None,
+                     max_inflight=256, debounce=0, max_delay=None):
+        """Watch several farms and report their status each time it changes
+
+        Farms are only re-evaluated when their properties or nodes
+        change. `result_handler` is called with `(zknode, status,
+        reason)`, first once the farm has been fetched and then on
+        each status change.
+        """
+        def check_handler(zknode, props, nodes):
+            return self._evaluate(zknode, props, nodes, max_failed_node, warn_failed_node)
+        group = WatcherGroup(debounce, max_delay)
+        for zknode in zknodes:
+            ZkFarmChecker(self.zkconn, zknode, check_handler, result_handler,
+                          max_inflight=max_inflight, group=group)
+        group.loop(ignore_unknown_transitions=True)
+
+    def _evaluate(self, zknode, props, nodes, max_failed_node, warn_failed_node):
+        """Compute the status of a farm from its properties and its nodes (name -> info)"""
         if 'size' not in props:
             return (self.STATUS_UNKNOWN, "No `size' property found for `%s' farm" % zknode)
         size = props['size']
-        running = 0
 
         try:
             max_failed = size * float(max_failed_node[0:-1]) / 100 if max_failed_node[-1] == '%' else int(max_failed_node)
@@ -98,13 +253,13 @@ class ZkFarmer(object):
             warn_failed = None
 
         if 'running_filter' in props:
-            filter_handler = create_filter(props['running_filter'])
-            for name in self.list(zknode):
-                info = self.get('%s/%s' % (zknode.rstrip('/'), name))
-                if filter_handler(info):
-                    running += 1
+            try:
+                filter_handler = create_filter(props['running_filter'])
+            except ValueError as e:
+                return (self.STATUS_UNKNOWN, "Invalid `running_filter' property for `%s' farm: %s" % (zknode, e))
+            running = len([name for name, info in nodes.iteritems() if filter_handler(info)])
         else:
-            running = len([x for x in self.list(zknode) if str(x) != "common"])
+            running = len([name for name in nodes if str(name) != "common"])
 
         failed = size - running
         if failed >= max_failed: